@@ -0,0 +1,162 @@
+import argparse
+import csv
+import fcntl
+import glob
+import gzip
+import logging
+import os
+from contextlib import ExitStack
+from itertools import chain
+from utils import DATA_DIR, create_dir, logger
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Archive:
+    """Append-only store of the raw andamentoTreno payloads of one day.
+
+    Each payload is compressed as an independent zstd frame (a gzip member
+    without the zstandard package) appended to {root}/{day}.jsonl.zst, and
+    a line station,train,offset,length is appended to {day}.idx, so any
+    payload can be read back alone. Appends are locked, so several
+    processes may write the same day; those writing a lot at once rather
+    each use their own `part`, stored as {day}.{part}.jsonl.zst.
+    """
+
+    def __init__(self, day, root=os.path.join(DATA_DIR, 'raw'), part=None):
+        create_dir(root)
+        extension = 'zst' if zstandard is not None else 'gz'
+        name = day if part is None else '{}.{}'.format(day, part)
+        self.fname = os.path.join(root, '{}.jsonl.{}'.format(name, extension))
+        self.index_fname = os.path.join(root, '{}.idx'.format(name))
+        self.f = None
+        self.f_index = None
+        if zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=3)
+            self.decompressor = zstandard.ZstdDecompressor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f_index.close()
+            self.f = None
+
+    def compress(self, data):
+        if zstandard is not None:
+            return self.compressor.compress(data)
+        return gzip.compress(data, compresslevel=5)
+
+    def decompress(self, data):
+        if zstandard is not None:
+            return self.decompressor.decompress(data)
+        return gzip.decompress(data)
+
+    def append(self, station_train, payload):
+        if self.f is None:
+            self.f = open(self.fname, 'ab')
+            self.f_index = open(self.index_fname, 'a')
+            self.index_writer = csv.writer(self.f_index)
+        frame = self.compress(payload.encode('utf-8') + b'\n')
+        # another process may have appended since our last write: the
+        # offset is the end of the file, taken under the lock
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        try:
+            offset = self.f.seek(0, os.SEEK_END)
+            self.f.write(frame)
+            # the payload first, so that the index never points past the data
+            self.f.flush()
+            self.index_writer.writerow(list(station_train) + [offset, len(frame)])
+            self.f_index.flush()
+        finally:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+
+    def index(self):
+        """(station, train, offset, length) of the payloads stored."""
+        if not os.path.exists(self.index_fname):
+            return []
+        with open(self.index_fname, 'r') as f:
+            return [(station, train, int(offset), int(length))
+                    for station, train, offset, length in csv.reader(f)]
+
+    def __iter__(self):
+        """Yield ((station, train), payload) in the order they were stored."""
+        with open(self.fname, 'rb') as f:
+            for station, train, offset, length in self.index():
+                f.seek(offset)
+                yield (station, train), self.decompress(f.read(length)).decode('utf-8').rstrip('\n')
+
+    def lookup(self, train_number):
+        """The payloads stored for `train_number`, as ((station, train), payload)."""
+        found = []
+        with open(self.fname, 'rb') as f:
+            for station, train, offset, length in self.index():
+                if train == str(train_number):
+                    f.seek(offset)
+                    found.append(((station, train), self.decompress(f.read(length)).decode('utf-8').rstrip('\n')))
+        return found
+
+
+def day_archives(day, root=os.path.join(DATA_DIR, 'raw')):
+    """The archives of `day`, its parts included."""
+    archives = []
+    for fname in sorted(glob.glob(os.path.join(root, '{}.idx'.format(day)))
+                        + glob.glob(os.path.join(root, '{}.*.idx'.format(day)))):
+        part = os.path.basename(fname)[len(day)+1:-len('.idx')] or None
+        archives.append(Archive(day, root, part))
+    return archives
+
+
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+@logger
+def replay(day, root=os.path.join(DATA_DIR, 'raw'), data_dir=os.path.join(DATA_DIR, 'replay'), workers=1, batch_size=500):
+    """Regenerate the daily csv files of `day` from the archive, without network."""
+    from get_train_status import write_to_files
+    create_dir(os.path.join(data_dir, 'train_status'))
+    create_dir(os.path.join(data_dir, 'single_train_status'))
+    with ExitStack() as stack:
+        archives = [stack.enter_context(archive) for archive in day_archives(day, root)]
+        write_to_files(batches(chain.from_iterable(archives), batch_size), day, workers=workers,
+                       data_dir=data_dir)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Regenerate the daily csv files from the raw archive')
+    parser.add_argument('day', help='YYYY-MM-DD')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--output-dir',
+                        help='data directory to write train_status/ and single_train_status/ into '
+                             '(default: replay/ in the data dir)')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=500)
+    return parser
+
+
+def main(configs):
+    data_dir = configs.get('data_dir', DATA_DIR)
+    replay(configs['day'], os.path.join(data_dir, 'raw'),
+           configs.get('output_dir') or os.path.join(data_dir, 'replay'),
+           configs.get('workers', 1), configs.get('batch_size', 500))
+
+
+if __name__ == '__main__':
+    main(vars(get_parser().parse_args()))
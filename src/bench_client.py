@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from aiohttp import web
+from utils import Client, call_urls
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.WARNING)
+
+
+def start_server(port, latency):
+    """Serve /{anything} on localhost from a background thread."""
+
+    async def handle(request):
+        await asyncio.sleep(latency)
+        return web.Response(text='{"numeroTreno": %s}' % request.match_info['n'])
+
+    def run(loop):
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get('/{n}', handle)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        loop.run_forever()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=run, args=(loop,), daemon=True).start()
+    time.sleep(0.5)
+
+
+def per_chunk_session(pages, chunk_size, **kwargs):
+    # what the scripts did before: a new loop run and session per chunk
+    for k in range(0, len(pages), chunk_size):
+        call_urls(pages[k:(k+chunk_size)], **kwargs)
+
+
+def shared_session(pages, chunk_size, **kwargs):
+    with Client(**kwargs) as client:
+        for k in range(0, len(pages), chunk_size):
+            call_urls(pages[k:(k+chunk_size)], client=client)
+
+
+def main(configs):
+    logging.getLogger().setLevel(logging.WARNING)
+    start_server(configs['port'], configs['latency'])
+    pages = [{'url': 'http://127.0.0.1:{}/{}'.format(configs['port'], n)}
+             for n in range(configs['requests'])]
+    client_configs = {'max_concurrency': configs['max_concurrency'],
+                      'rate': configs['rate']}
+
+    timings = {}
+    for name, fn in [('per-chunk session', per_chunk_session),
+                     ('shared session', shared_session)]:
+        start_time = time.time()
+        fn(pages, configs['chunk_size'], **client_configs)
+        timings[name] = time.time() - start_time
+        print('{:<20}{:>8.2f} s{:>10.0f} req/s'.format(
+            name, timings[name], len(pages)/timings[name]))
+
+    print('speedup: {:.2f}x'.format(
+        timings['per-chunk session']/timings['shared session']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark a shared Client against one session per chunk')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--chunk-size', type=int, default=50)
+    parser.add_argument('--max-concurrency', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=100000)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--port', type=int, default=8899)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,43 @@
+import argparse
+import logging
+import time
+from random import seed
+from bench_train import make_payload
+from delays import segment_delays, stops_arrays, train_delays
+from utils import train
+
+
+def main(configs):
+    logging.getLogger().setLevel(logging.ERROR)
+    seed(0)
+    trains = [train(make_payload(n, configs['stops'])) for n in range(configs['trains'])]
+    rows = configs['trains'] * 2 * (configs['stops']-1)
+
+    start_time = time.time()
+    expected = [(segment['train_number'], segment['step'],
+                 segment['inc_delay'], segment['seg_delay'], segment['fin_delay'])
+                for single_train in trains for segment in single_train.parse_segments()]
+    per_object = time.time() - start_time
+
+    start_time = time.time()
+    arrays = stops_arrays(trains)
+    to_arrays = time.time() - start_time
+
+    start_time = time.time()
+    segment_delays(*arrays)
+    vectorised = time.time() - start_time
+
+    for name, elapsed in [('parse_segments', per_object),
+                          ('stops_arrays', to_arrays),
+                          ('segment_delays', vectorised),
+                          ('stops_arrays + segment_delays', to_arrays + vectorised)]:
+        print('{:<32}{:>8.3f} s{:>14.0f} rows/s'.format(name, elapsed, rows/elapsed))
+
+    print('identical output:', train_delays(trains) == expected)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the vectorised delays against parse_segments')
+    parser.add_argument('--trains', type=int, default=20000)
+    parser.add_argument('--stops', type=int, default=30)
+    main(vars(parser.parse_args()))
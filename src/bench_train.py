@@ -0,0 +1,93 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import subprocess
+import time
+import types
+from random import randint, random, seed
+from utils import SEGMENT_FIELDS, train
+
+
+def make_payload(train_number, num_stops=30, start=None, station_ids=None):
+    """Synthetic andamentoTreno payload with random delays and some
+    missing real times, stopping at `station_ids` if given."""
+    start = int(start or time.time()*1000)
+    if station_ids is not None:
+        num_stops = len(station_ids)
+    stops = []
+    delay = 0
+    for k in range(num_stops):
+        planned = start + k*300000
+        delay = max(0, delay + randint(-60, 120)*1000)
+        stop = {'id': station_ids[k] if station_ids is not None else 'S{:05d}'.format(randint(0, 3000))}
+        if k > 0:
+            stop['arrivo_teorico'] = planned
+            stop['arrivoReale'] = planned + delay if random() > 0.05 else None
+        if k < num_stops-1:
+            stop['partenza_teorica'] = planned + 60000
+            stop['partenzaReale'] = planned + 60000 + delay if random() > 0.05 else None
+        stops.append(stop)
+    return json.dumps({'numeroTreno': train_number, 'tipoTreno': 'PG',
+                       'categoria': 'REG', 'provvedimento': 0, 'orarioPartenzaZero': start + 60000,
+                       'idOrigine': stops[0]['id'], 'origine': 'ORIGINE',
+                       'idDestinazione': stops[-1]['id'], 'destinazione': 'DESTINAZIONE',
+                       'fermateSoppresse': [], 'fermate': stops})
+
+
+def load_baseline(rev):
+    """The train class as it was at git revision `rev`."""
+    source = subprocess.run(['git', 'show', '{}:src/utils.py'.format(rev)],
+                            check=True, capture_output=True, text=True).stdout
+    module = types.ModuleType('utils_{}'.format(rev))
+    exec(source, module.__dict__)
+    return module.train
+
+
+def dict_path(payloads, train_class):
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames=SEGMENT_FIELDS)
+    for item in payloads:
+        for segment in train_class(item).parse_segments():
+            writer.writerow(segment)
+    return f.getvalue()
+
+
+def tuple_path(payloads):
+    f = io.StringIO()
+    writer = csv.writer(f)
+    for item in payloads:
+        writer.writerows(train(item).iter_segments())
+    return f.getvalue()
+
+
+def main(configs):
+    logging.getLogger().setLevel(logging.ERROR)
+    seed(0)
+    payloads = [make_payload(n, configs['stops']) for n in range(configs['trains'])]
+    rows = configs['trains'] * 2 * (configs['stops']-1)
+
+    candidates = [('parse_segments + DictWriter', lambda: dict_path(payloads, train)),
+                  ('iter_segments + writer', lambda: tuple_path(payloads))]
+    if configs['baseline_rev']:
+        baseline = load_baseline(configs['baseline_rev'])
+        candidates.insert(0, ('baseline ' + configs['baseline_rev'],
+                              lambda: dict_path(payloads, baseline)))
+
+    outputs = []
+    for name, fn in candidates:
+        start_time = time.time()
+        outputs.append(fn())
+        elapsed = time.time() - start_time
+        print('{:<32}{:>8.2f} s{:>12.0f} rows/s'.format(name, elapsed, rows/elapsed))
+
+    print('identical output:', all(output == outputs[0] for output in outputs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark parsing and writing of train segments')
+    parser.add_argument('--trains', type=int, default=5000)
+    parser.add_argument('--stops', type=int, default=30)
+    parser.add_argument('--baseline-rev', help='also time the train class at this git revision')
+    main(vars(parser.parse_args()))
@@ -0,0 +1,142 @@
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from mock_server import get_parser, start_in_thread
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+STAGES = ('stations', 'numbers', 'status')
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+def run_stage(stage, configs, queue):
+    """Run one script against the mock server and report its figures.
+
+    Runs in its own process, so that the peak RSS is the stage's own.
+    """
+    os.chdir(os.path.join(configs['workdir'], 'src'))
+    data_dir = os.path.join(configs['workdir'], 'data')
+    logging.getLogger().setLevel(logging.WARNING)
+    import utils
+    import metrics
+    metrics.registry.reset()
+    # before importing the scripts, which copy them
+    utils.VIAGGIATRENO_URL = configs['base_url']
+    utils.GEOCODER_URL = configs['base_url']
+    utils.MAX_CONCURRENCY = configs['max_concurrency']
+    utils.RATE = configs['rate']
+
+    # the limiters are told the latency of every response
+    latencies = []
+    feedback = utils.HostLimiter.feedback
+
+    def timed_feedback(self, status, latency, retry_after=None):
+        latencies.append(latency)
+        return feedback(self, status, latency, retry_after)
+
+    utils.HostLimiter.feedback = timed_feedback
+
+    parsed = {'rows': 0, 'seconds': 0}
+    start_time = time.time()
+    if stage == 'stations':
+        import get_stations
+        get_stations.main({'data_dir': data_dir})
+    elif stage == 'numbers':
+        import get_train_numbers
+        get_train_numbers.main_prefix({'output_file': os.path.join(data_dir, 'starting_stations.csv'),
+                                       'max_digits': 5,
+                                       'page_limit': configs['autocomplete_limit']})
+    elif stage == 'status':
+        import get_train_status
+        parse_train_status = get_train_status.parse_train_status
+
+        def timed_parse_train_status(item, *args, **kwargs):
+            parse_start = time.time()
+            result = parse_train_status(item, *args, **kwargs)
+            parsed['seconds'] += time.time() - parse_start
+            if result is not None:
+                parsed['rows'] += result[2].count('\n')
+            return result
+
+        get_train_status.parse_train_status = timed_parse_train_status
+        get_train_status.main({'data_dir': data_dir, 'workers': 1, 'batch_size': configs['batch_size']})
+    elapsed = time.time() - start_time
+
+    queue.put({'stage': stage,
+               'requests': len(latencies),
+               'seconds': round(elapsed, 3),
+               'requests_per_s': round(len(latencies)/elapsed, 1),
+               'p50_ms': round(1000*percentile(latencies, 0.5), 1) if latencies else None,
+               'p99_ms': round(1000*percentile(latencies, 0.99), 1) if latencies else None,
+               'retries': metrics.registry.counter('http_retries_total'),
+               'downloaded_mb': round(metrics.registry.counter('http_response_bytes_total')/2**20, 1),
+               'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1),
+               'parse_rows_per_s': round(parsed['rows']/parsed['seconds']) if parsed['seconds'] else None})
+
+
+def compare(results, baseline):
+    print('\nagainst baseline:')
+    for result in results:
+        before = baseline.get(result['stage'], {})
+        changes = []
+        for key in ('requests_per_s', 'p50_ms', 'p99_ms', 'peak_rss_mb', 'parse_rows_per_s'):
+            if result.get(key) and before.get(key):
+                changes.append('{} {:+.1f}%'.format(key, 100*(result[key]/before[key] - 1)))
+        print('{:<10}{}'.format(result['stage'], ', '.join(changes)))
+
+
+def main(configs):
+
+    configs['base_url'] = 'http://{}:{}'.format(configs['host'], configs['port'])
+    start_in_thread(configs)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configs['workdir'] = workdir
+        os.makedirs(os.path.join(workdir, 'src'))
+        os.makedirs(os.path.join(workdir, 'data'))
+
+        results = []
+        context = multiprocessing.get_context('fork')
+        for stage in configs['stages']:
+            logging.info("Running %s", stage)
+            queue = context.Queue()
+            process = context.Process(target=run_stage, args=(stage, configs, queue))
+            process.start()
+            results.append(queue.get())
+            process.join()
+
+    header = ('stage', 'requests', 'seconds', 'requests_per_s', 'p50_ms', 'p99_ms',
+              'retries', 'downloaded_mb', 'peak_rss_mb', 'parse_rows_per_s')
+    print(''.join('{:>17}'.format(key) for key in header))
+    for result in results:
+        print(''.join('{:>17}'.format(str(result[key])) for key in header))
+
+    if configs['output']:
+        with open(configs['output'], 'w') as f:
+            json.dump({result['stage']: result for result in results}, f, indent=2)
+    if configs['baseline']:
+        with open(configs['baseline']) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.description = 'Run the scripts against the local mock server and report their throughput'
+    parser.set_defaults(port=8898)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--max-concurrency', type=int, default=20, help='of the scripts\' clients')
+    parser.add_argument('--rate', type=float, default=10, help='requests/s of the scripts\' clients')
+    parser.add_argument('--output', help='save the results as json, to use as --baseline later')
+    parser.add_argument('--baseline', help='json results of a previous run to compare with')
+    main(vars(parser.parse_args()))
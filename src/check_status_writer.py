@@ -0,0 +1,168 @@
+import argparse
+import csv
+import logging
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Process
+from random import Random, seed
+from bench_train import make_payload
+from get_train_status import write_to_files
+from status_writer import TABLES, StatusWriter
+
+
+def make_items(trains, stops):
+    """(station, train), payload pairs, a tenth of them leaving yesterday."""
+    now = time.time()*1000
+    return [(('S{}'.format(n % 7), str(n)),
+             make_payload(n, stops, start=now - (86400000 if n % 10 == 0 else 0)))
+            for n in range(trains)]
+
+
+def split(items, size):
+    return [items[k:k+size] for k in range(0, len(items), size)]
+
+
+def read_tables(data_dir):
+    """{(table, day): (sorted rows, headers)} of the daily files."""
+    out = {}
+    for table in TABLES:
+        for name in sorted(os.listdir(os.path.join(data_dir, table))):
+            if not name.endswith('.csv'):
+                continue
+            with open(os.path.join(data_dir, table, name), 'r', newline='') as f:
+                rows = list(csv.reader(f))
+            out[(table, name[:-4])] = (sorted(rows[1:]), sum(row == list(TABLES[table]) for row in rows),
+                                       rows[0] == list(TABLES[table]))
+    return out
+
+
+def left_over(data_dir):
+    """Segments, temporary files and journals not cleaned up."""
+    names = []
+    for table in TABLES:
+        for root, _, files in os.walk(os.path.join(data_dir, table)):
+            names += [name for name in files if not name.endswith(('.csv', '.lock')) or root.endswith('.d')]
+    return names
+
+
+def concurrent_writer(items, data_dir, k):
+    logging.getLogger().setLevel(logging.ERROR)
+    shuffled = items[:]
+    Random(k).shuffle(shuffled)
+    write_to_files(split(shuffled, 37), data_dir=data_dir, compact=False)
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_compaction(data_dir, day, fail_replace=None, fail_remove=False):
+    """Compact `day`, raising Crash at the os.replace of the daily file of
+    table `fail_replace`, or at the first segment removal."""
+    real_replace, real_remove = os.replace, os.remove
+
+    def replace(src, dst):
+        if fail_replace is not None and dst == StatusWriter(data_dir).base(fail_replace, day):
+            raise Crash(dst)
+        return real_replace(src, dst)
+
+    def remove(fname):
+        if fail_remove and '.d' + os.sep in fname:
+            raise Crash(fname)
+        return real_remove(fname)
+
+    os.replace, os.remove = replace, remove
+    try:
+        StatusWriter(data_dir).compact(day)
+    except Crash:
+        return True
+    finally:
+        os.replace, os.remove = real_replace, real_remove
+    return False
+
+
+def main(configs):
+    logging.getLogger().setLevel(logging.ERROR)
+    seed(0)
+    items = make_items(configs['trains'], configs['stops'])
+    root = configs['data_dir'] or tempfile.mkdtemp(prefix='check_status_writer')
+    results = []
+
+    def check(name, data_dir, expected):
+        tables = read_tables(data_dir)
+        ok = (tables == expected and all(headers == 1 and first for _, headers, first in tables.values())
+              and left_over(data_dir) == [])
+        results.append(ok)
+        print('{:<56}{}'.format(name, 'ok' if ok else 'FAILED'))
+
+    def fresh(name):
+        data_dir = os.path.join(root, name)
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return data_dir
+
+    # reference: one writer, each train once
+    data_dir = fresh('reference')
+    write_to_files(split(items, 100), data_dir=data_dir)
+    expected = read_tables(data_dir)
+    print('{} trains written to {} daily files'.format(len(items), len(expected)))
+
+    # the same trains again, in overlapping batches
+    write_to_files(split(items[len(items)//4:], 70) + split(items, 150), data_dir=data_dir)
+    check('overlapping re-run', data_dir, expected)
+
+    data_dir = fresh('concurrent')
+    writers = [Process(target=concurrent_writer, args=(items, data_dir, k)) for k in range(configs['writers'])]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    StatusWriter(data_dir).compact_all()
+    check('{} concurrent writers'.format(configs['writers']), data_dir, expected)
+
+    # a writer dying between its two renames leaves a single_train_status
+    # segment alone, dropped at compaction
+    data_dir = fresh('uncommitted')
+    write_to_files(split(items, 100), data_dir=data_dir, compact=False)
+    day = time.strftime('%Y-%m-%d', time.localtime(time.time()))
+    writer = StatusWriter(data_dir)
+    with open(os.path.join(writer.segments_dir('single_train_status', day), '0-0-000000.csv'), 'w') as f:
+        f.write('orphan,row\n')
+    writer.compact_all()
+    check('uncommitted segment', data_dir, expected)
+
+    # crashes at each step of a compaction, recovered by the next one,
+    # with or without new segments to add
+    half, three_quarters = len(items)//2, 3*len(items)//4
+    for name, crash in (('single_train_status', {'fail_replace': 'single_train_status'}),
+                        ('train_status', {'fail_replace': 'train_status'}),
+                        ('segment removal', {'fail_remove': True})):
+        for more in (False, True):
+            data_dir = fresh('crash')
+            write_to_files(split(items[:half], 100), data_dir=data_dir)
+            write_to_files(split(items[half:three_quarters], 100), data_dir=data_dir, compact=False)
+            results.append(crash_compaction(data_dir, day, **crash))
+            if more:
+                write_to_files(split(items, 100), data_dir=data_dir)
+            else:
+                StatusWriter(data_dir).compact_all()
+                write_to_files(split(items[three_quarters:], 100), data_dir=data_dir)
+            check('crash at {} ({})'.format(name, 'with new trains' if more else 'compacted alone'),
+                  data_dir, expected)
+
+    if not configs['data_dir']:
+        shutil.rmtree(root)
+    print('all checks passed:', all(results))
+    return all(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that StatusWriter writes each train once across re-runs, concurrent '
+                    'writers and crashes during compaction')
+    parser.add_argument('--trains', type=int, default=400)
+    parser.add_argument('--stops', type=int, default=6)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--data-dir', help='keep the files here (default: a temporary directory)')
+    raise SystemExit(0 if main(vars(parser.parse_args())) else 1)
@@ -0,0 +1,157 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from archive import Archive
+from get_train_status import get_train_status_from_API, read_starting_stations, train_sort_key, write_to_files
+from status_writer import StatusWriter
+from utils import DATA_DIR, Client, create_dir, logger
+from work_queue import WorkQueue
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+def queue_fname(data_dir):
+    return os.path.join(data_dir, 'train_status', 'queue.sqlite')
+
+
+class Acker:
+    """Stands for the checkpoint writer of write_to_files: acks the pairs
+    of each batch once it is written."""
+
+    def __init__(self, queue, day, owner):
+        self.queue = queue
+        self.day = day
+        self.owner = owner
+
+    def writerows(self, pairs):
+        self.queue.ack(self.day, self.owner, list(pairs))
+
+
+def leased_batches(queue, day, owner, client, batch_size=100, lease_seconds=300, poll=5):
+    """Lease, download and yield batches of the pairs queued for `day` as
+    get_train_status_batches does, until none is pending or leased. The
+    pairs that could not be downloaded are released at once."""
+    while True:
+        pairs = queue.lease(day, owner, batch_size, lease_seconds)
+        if len(pairs) == 0:
+            if queue.remaining(day) == 0:
+                return
+            # the rest is leased by other workers: wait for them to ack it,
+            # or for their leases to expire
+            time.sleep(poll)
+            continue
+        batch = list(get_train_status_from_API(pairs, client))
+        returned = set(station_train for station_train, _ in batch)
+        queue.release(day, owner, [pair for pair in pairs if pair not in returned])
+        yield batch
+
+
+def crawl(configs, owner):
+    """Worker: crawl the queue with its own client, so its own rate limit,
+    writing segments that the coordinator compacts."""
+    data_dir = configs.get('data_dir', DATA_DIR)
+    day = configs['day']
+    with WorkQueue(queue_fname(data_dir)) as queue, \
+            Archive(day, os.path.join(data_dir, 'raw'), part=owner) as archive, \
+            Client(rate=configs.get('rate')) as client:
+        batches = leased_batches(queue, day, owner, client, configs.get('batch_size', 100),
+                                 configs.get('lease', 300))
+        write_to_files(batches, day, Acker(queue, day, owner), 1, archive, data_dir, compact=False)
+    logging.info("Worker %s done", owner)
+
+
+def enqueue(queue, day, data_dir=DATA_DIR):
+    station_id_train = read_starting_stations(os.path.join(data_dir, 'starting_stations.csv'))
+    # in train number order, as get_train_status.main
+    station_id_train.sort(key=lambda item: train_sort_key(item[1], item[0]))
+    added = queue.put(day, station_id_train)
+    logging.info("Queued %s new trains/stations for %s (%s)", added, day, queue.counts(day))
+
+
+@logger
+def main(configs):
+    """Coordinator: queue the trains of the day, run `crawlers` worker
+    processes on them and merge their output into the daily files.
+
+    Workers on other hosts join with --join, given a data dir shared over
+    a filesystem with working locks (the queue is sqlite and the writers
+    lock the day); the coordinator waits for them too before merging.
+    """
+    data_dir = configs.get('data_dir', DATA_DIR)
+    day = configs.get('day') or time.strftime('%Y-%m-%d', time.localtime(time.time()))
+    configs = dict(configs, day=day)
+    create_dir(os.path.join(data_dir, 'train_status'))
+    create_dir(os.path.join(data_dir, 'single_train_status'))
+
+    with WorkQueue(queue_fname(data_dir)) as queue:
+        if not configs.get('join'):
+            enqueue(queue, day, data_dir)
+
+        host = socket.gethostname()
+        workers = [multiprocessing.Process(target=crawl, args=(configs, '{}-{}-{}'.format(host, os.getpid(), k)))
+                   for k in range(configs.get('crawlers', 1))]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(configs.get('progress_every', 30))
+            logging.info("Queue of %s: %s", day, queue.counts(day))
+        for worker in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                logging.error("Worker %s exited with %s", worker.pid, worker.exitcode)
+
+        # pairs left pending or leased when every worker exited, e.g. after
+        # they all crashed, are reported with the failed ones
+        failed_fname = os.path.join(data_dir, 'train_status', '{}.failed'.format(day))
+        unfinished = queue.unfinished(day)
+        if len(unfinished) > 0:
+            logging.error("%s trains/stations not crawled by the workers, listed in %s",
+                          len(unfinished), failed_fname)
+        failed = queue.failed(day) + unfinished
+        if len(failed) > 0:
+            with open(failed_fname, 'w') as f:
+                f.writelines('{},{}\n'.format(station, train) for station, train in failed)
+        logging.info("Queue of %s: %s", day, queue.counts(day))
+        if configs.get('join'):
+            return
+
+    days = StatusWriter(data_dir).compact_all()
+
+    if not configs.get('no_stats'):
+        from delay_stats import update
+        update(data_dir, days)
+
+    if configs.get('parquet'):
+        from parquet_store import convert_day
+        for trip_date in days:
+            convert_day(trip_date, data_dir)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Download the status of all the trains of the day with several workers sharing a queue')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--crawlers', type=int, default=1,
+                        help='worker processes, each with its own rate limit (default: 1)')
+    parser.add_argument('--rate', type=float,
+                        help='requests per second of each worker (default: utils.RATE)')
+    parser.add_argument('--join', action='store_true',
+                        help='only work on the queue filled by a coordinator, e.g. from another host')
+    parser.add_argument('--day', help='day of the crawl (YYYY-MM-DD, default: today)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='trains leased, fetched and written together (default: 100)')
+    parser.add_argument('--lease', type=int, default=300,
+                        help='seconds before the trains leased by a silent worker go to the others (default: 300)')
+    parser.add_argument('--progress-every', type=int, default=30,
+                        help='seconds between progress logs (default: 30)')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not update the delay statistics of the days written')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also store the days in the parquet store under parquet/ in the data dir')
+    return parser
+
+
+if __name__ == '__main__':
+    main(vars(get_parser().parse_args()))
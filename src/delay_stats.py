@@ -0,0 +1,240 @@
+import argparse
+import csv
+import glob
+import logging
+import math
+import os
+import sqlite3
+import time
+import numpy as np
+from utils import DATA_DIR, SEGMENT_FIELDS, TRAIN_FIELDS, logger
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+# delays are counted in bins of BIN_WIDTH s between MIN_BIN and MAX_BIN,
+# the ones beyond in the first and last bin
+BIN_WIDTH = 10
+MIN_BIN = -360
+MAX_BIN = 4320
+METRICS = ('seg_delay', 'fin_delay')
+# station: the to_id of a segment, i.e. the delays at arrival and departure
+# link: from_id-to_id of the segments between two stations
+KINDS = ('day', 'category', 'station', 'link')
+
+
+def delay_bins(delays):
+    return np.clip(np.floor_divide(delays, BIN_WIDTH), MIN_BIN, MAX_BIN).astype(np.int64)
+
+
+def percentile(bins, q):
+    """`q` percentile of the delays counted in `bins` ({bin: count}),
+    interpolated within its bin."""
+    total = sum(bins.values())
+    if total == 0:
+        return None
+    target = q/100*total
+    seen = 0
+    for k in sorted(bins):
+        if seen + bins[k] >= target:
+            return BIN_WIDTH*(k + (target - seen)/bins[k])
+        seen += bins[k]
+    return BIN_WIDTH*(max(bins) + 1)
+
+
+def aggregate_day(segments_fname, trains_fname=None):
+    """Count, sum, sum of squares and histogram of each metric of the rows
+    of a single_train_status file, per kind and key: returns
+    {(kind, key, metric): (n, total, total_sq)} and
+    {(kind, key, metric, bin): n}."""
+    categories = {}
+    if trains_fname is not None and os.path.exists(trains_fname):
+        with open(trains_fname, 'r', newline='') as f:
+            number, category = TRAIN_FIELDS.index('train_number'), TRAIN_FIELDS.index('category')
+            for row in csv.reader(f):
+                if len(row) == len(TRAIN_FIELDS) and row[0] != TRAIN_FIELDS[0]:
+                    categories[row[number]] = row[category]
+
+    columns = [SEGMENT_FIELDS.index(field) for field in ('train_number', 'from_id', 'to_id') + METRICS]
+    with open(segments_fname, 'r', newline='') as f:
+        rows = [[row[k] for k in columns] for row in csv.reader(f)
+                if len(row) == len(SEGMENT_FIELDS) and row[0] != SEGMENT_FIELDS[0]]
+    moments = {}
+    bins = {}
+    if len(rows) == 0:
+        return moments, bins
+
+    train_numbers, from_ids, to_ids, *values = zip(*rows)
+    from_ids = np.array(from_ids)
+    to_ids = np.array(to_ids)
+    keys = {'day': (np.zeros(len(rows), dtype='<U1'), None),
+            'category': (np.array([categories.get(number, '') for number in train_numbers]), None),
+            'station': (to_ids, None),
+            'link': (np.char.add(np.char.add(from_ids, '-'), to_ids), from_ids != to_ids)}
+    for metric, metric_values in zip(METRICS, values):
+        delays = np.array([float(value) if value != '' else np.nan for value in metric_values])
+        for kind, (kind_keys, mask) in keys.items():
+            valid = ~np.isnan(delays)
+            if mask is not None:
+                valid &= mask
+            names, codes = np.unique(kind_keys[valid], return_inverse=True)
+            kind_delays = delays[valid]
+            n = np.bincount(codes, minlength=len(names))
+            total = np.bincount(codes, weights=kind_delays, minlength=len(names))
+            total_sq = np.bincount(codes, weights=kind_delays*kind_delays, minlength=len(names))
+            for name, entry in zip(names.tolist(), zip(n.tolist(), total.tolist(), total_sq.tolist())):
+                moments[(kind, name, metric)] = entry
+
+            num_bins = MAX_BIN - MIN_BIN + 1
+            code_bins, counts = np.unique(codes*num_bins + delay_bins(kind_delays) - MIN_BIN, return_counts=True)
+            for code_bin, count in zip(code_bins.tolist(), counts.tolist()):
+                bins[(kind, names[code_bin // num_bins], metric, code_bin % num_bins + MIN_BIN)] = count
+    return moments, bins
+
+
+class DelayStats:
+    """Aggregates of seg_delay and fin_delay per day and station, link,
+    train category or the whole day, kept in sqlite.
+
+    Each day is summarised once from its single_train_status file (and
+    again only when the file changes), so queries over months read a few
+    thousand rows per key instead of the raw segments. Percentiles come
+    from histograms of BIN_WIDTH s bins.
+    """
+
+    def __init__(self, path=os.path.join(DATA_DIR, 'delay_stats.sqlite')):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS days (
+                           day TEXT PRIMARY KEY,
+                           source_size INTEGER,
+                           source_mtime REAL,
+                           updated_at REAL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS moments (
+                           kind TEXT, key TEXT, metric TEXT, day TEXT,
+                           n INTEGER, total REAL, total_sq REAL,
+                           PRIMARY KEY (kind, metric, key, day)) WITHOUT ROWID''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS bins (
+                           kind TEXT, key TEXT, metric TEXT, day TEXT, bin INTEGER, n INTEGER,
+                           PRIMARY KEY (kind, metric, key, day, bin)) WITHOUT ROWID''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def update_day(self, day, data_dir=DATA_DIR, force=False):
+        """(Re)compute the aggregates of `day`, unless its file did not
+        change since the last time. Returns whether it did."""
+        fname = os.path.join(data_dir, 'single_train_status', '{}.csv'.format(day))
+        if not os.path.exists(fname):
+            return False
+        stat = os.stat(fname)
+        known = self.db.execute('SELECT source_size, source_mtime FROM days WHERE day = ?', (day,)).fetchone()
+        if not force and known == (stat.st_size, stat.st_mtime):
+            return False
+
+        start_time = time.time()
+        moments, bins = aggregate_day(fname, os.path.join(data_dir, 'train_status', '{}.csv'.format(day)))
+        with self.db:
+            self.db.execute('DELETE FROM moments WHERE day = ?', (day,))
+            self.db.execute('DELETE FROM bins WHERE day = ?', (day,))
+            self.db.executemany('INSERT INTO moments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                ((kind, key, metric, day, n, total, total_sq)
+                                 for (kind, key, metric), (n, total, total_sq) in moments.items()))
+            self.db.executemany('INSERT INTO bins VALUES (?, ?, ?, ?, ?, ?)',
+                                ((kind, key, metric, day, value_bin, n)
+                                 for (kind, key, metric, value_bin), n in bins.items()))
+            self.db.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?)',
+                            (day, stat.st_size, stat.st_mtime, time.time()))
+        logging.info("Delay statistics of %s updated (%s s)", day, round(time.time() - start_time, 2))
+        return True
+
+    def update_all(self, data_dir=DATA_DIR, force=False):
+        days = sorted(os.path.basename(fname)[:-4]
+                      for fname in glob.glob(os.path.join(data_dir, 'single_train_status', '*.csv')))
+        return [day for day in days if self.update_day(day, data_dir, force)]
+
+    def days(self):
+        return [day for day, in self.db.execute('SELECT day FROM days ORDER BY day')]
+
+    def query(self, kind, metric='seg_delay', keys=None, start=None, end=None, by_day=False,
+              percentiles=(50, 90, 99)):
+        """Statistics of `metric` per key of `kind` (one of KINDS) over the
+        days from `start` to `end` (YYYY-MM-DD, inclusive), or per key and
+        day with `by_day`. Returns dicts with kind, key, (day,) n, mean,
+        std and p50, p90, ... delays in s."""
+        where = 'kind = ? AND metric = ? AND day >= ? AND day <= ?'
+        params = [kind, metric, start or '', end or '9999']
+        if keys is not None:
+            keys = [str(key) for key in keys]
+            where += ' AND key IN ({})'.format(','.join('?'*len(keys)))
+            params += keys
+        group = 'key, day' if by_day else 'key'
+
+        results = {}
+        for row in self.db.execute('SELECT {}, SUM(n), SUM(total), SUM(total_sq) FROM moments WHERE {} GROUP BY {}'
+                                   .format(group, where, group), params):
+            *group_key, n, total, total_sq = row
+            mean = total/n
+            results[tuple(group_key)] = dict(zip(('key', 'day'), group_key), kind=kind, metric=metric, n=n,
+                                             mean=mean, std=math.sqrt(max(total_sq/n - mean*mean, 0)))
+        histograms = {}
+        for row in self.db.execute('SELECT {}, bin, SUM(n) FROM bins WHERE {} GROUP BY {}, bin'
+                                   .format(group, where, group), params):
+            *group_key, value_bin, n = row
+            histograms.setdefault(tuple(group_key), {})[value_bin] = n
+        for group_key, result in results.items():
+            for q in percentiles:
+                result['p{}'.format(q)] = percentile(histograms.get(group_key, {}), q)
+        return [results[group_key] for group_key in sorted(results)]
+
+
+@logger
+def update(data_dir=DATA_DIR, days=None, force=False):
+    """Update the statistics of `days` (all the days stored if None)."""
+    with DelayStats(os.path.join(data_dir, 'delay_stats.sqlite')) as stats:
+        if days is None:
+            return stats.update_all(data_dir, force)
+        return [day for day in sorted(days) if stats.update_day(day, data_dir, force)]
+
+
+def main(configs):
+    data_dir = configs.get('data_dir', DATA_DIR)
+    if configs.get('kind') is None:
+        update(data_dir, [configs['day']] if configs.get('day') else None, configs.get('force'))
+        return
+
+    with DelayStats(os.path.join(data_dir, 'delay_stats.sqlite')) as stats:
+        results = stats.query(configs['kind'], configs.get('metric', 'seg_delay'), configs.get('key'),
+                              configs.get('start'), configs.get('end'), configs.get('by_day'))
+    results.sort(key=lambda result: -result['n'])
+    header = ('key', 'day', 'n', 'mean', 'std', 'p50', 'p90', 'p99')
+    print(''.join('{:>14}'.format(field) for field in header))
+    for result in results[:configs.get('limit', 20)]:
+        print(''.join('{:>14}'.format(str(round(value, 1)) if isinstance(value, float) else str(value))
+                      for value in (result.get(field, '') for field in header)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Update the delay statistics of the days stored, or query them with --kind')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--day', help='only update this day (YYYY-MM-DD)')
+    parser.add_argument('--force', action='store_true', help='recompute the days even if unchanged')
+    parser.add_argument('--kind', choices=KINDS, help='query the statistics per day, category, station or link')
+    parser.add_argument('--metric', choices=METRICS, default='seg_delay')
+    parser.add_argument('--key', nargs='+', help='only these stations, links (FROM-TO) or categories')
+    parser.add_argument('--start', help='first day (YYYY-MM-DD)')
+    parser.add_argument('--end', help='last day (YYYY-MM-DD)')
+    parser.add_argument('--by-day', action='store_true', help='one row per key and day')
+    parser.add_argument('--limit', type=int, default=20, help='rows printed, most frequent keys first')
+    return parser
+
+
+if __name__ == '__main__':
+    main(vars(get_parser().parse_args()))
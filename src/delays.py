@@ -0,0 +1,78 @@
+import numpy as np
+import numpy.ma as ma
+
+
+def stops_arrays(trains):
+    """Flatten the stops of `trains` into the inputs of segment_delays:
+    the number of stops of each train and masked arrays (ms, masked where
+    missing) of planned and real arrival and departure."""
+    counts = np.array([len(single_train.stops) for single_train in trains], dtype=np.int64)
+    # None becomes nan, which is exact for ms timestamps
+    values = np.array([(stop.get('arrivo_teorico'), stop.get('arrivoReale'),
+                        stop.get('partenza_teorica'), stop.get('partenzaReale'))
+                       for single_train in trains for stop in single_train.stops],
+                      dtype=np.float64).reshape(-1, 4)
+    mask = np.isnan(values)
+    values = np.where(mask, 0, values).astype(np.int64)
+    return (counts,) + tuple(ma.masked_array(values[:, k], mask[:, k]) for k in range(4))
+
+
+def seconds(start, end):
+    # int((end - start)/1000), truncating towards zero
+    return np.trunc((end - start)/1000).astype(np.int64)
+
+
+def segment_delays(counts, arr_pl, arr_real, dep_pl, dep_real):
+    """Incoming, segment and final delay (s) of all the segments of many
+    trains at once, as parse_segments computes them one by one.
+
+    `counts` holds the number of stops of each train, the other arguments
+    the stops of all the trains one after the other. Returns the train
+    (index into counts) and step of each segment and the three delays as
+    masked arrays, masked where parse_segments gives None.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    arr_pl, arr_real, dep_pl, dep_real = (ma.asarray(a) for a in (arr_pl, arr_real, dep_pl, dep_real))
+
+    # every stop but the last of its train starts two segments:
+    # the stop itself (arrival to departure) and the trip to the next stop
+    last = np.cumsum(counts) - 1
+    starts = np.ones(len(arr_pl), dtype=bool)
+    starts[last[counts > 0]] = False
+    k = np.flatnonzero(starts)
+
+    def interleave(a, b):
+        out = ma.empty(2*len(k), dtype=np.int64)
+        out[0::2] = a
+        out[1::2] = b
+        return out
+
+    start_pl = interleave(arr_pl[k], dep_pl[k])
+    start_real = interleave(arr_real[k], dep_real[k])
+    end_pl = interleave(dep_pl[k], arr_pl[k+1])
+    end_real = interleave(dep_real[k], arr_real[k+1])
+
+    start_ok = ~(ma.getmaskarray(start_pl) | ma.getmaskarray(start_real))
+    end_ok = ~(ma.getmaskarray(end_pl) | ma.getmaskarray(end_real))
+    incoming = seconds(start_pl.filled(0), start_real.filled(0))
+    final = seconds(end_pl.filled(0), end_real.filled(0))
+
+    train_index = np.repeat(np.arange(len(counts)), 2*np.maximum(counts-1, 0))
+    first_segment = np.repeat(np.cumsum(2*np.maximum(counts-1, 0)) - 2*np.maximum(counts-1, 0),
+                              2*np.maximum(counts-1, 0))
+    step = np.arange(len(train_index)) - first_segment
+
+    return (train_index, step,
+            ma.masked_array(incoming, ~start_ok),
+            ma.masked_array(final - incoming, ~(start_ok & end_ok)),
+            ma.masked_array(final, ~end_ok))
+
+
+def train_delays(trains):
+    """(train_number, step, inc_delay, seg_delay, fin_delay) tuples of
+    `trains`, with None for the missing delays."""
+    train_index, step, incoming, segment, final = segment_delays(*stops_arrays(trains))
+    train_numbers = [single_train.train_number for single_train in trains]
+    return [(train_numbers[t], s, i, g, f)
+            for t, s, i, g, f in zip(train_index.tolist(), step.tolist(),
+                                     incoming.tolist(), segment.tolist(), final.tolist())]
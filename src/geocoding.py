@@ -0,0 +1,104 @@
+import csv
+import json
+import logging
+import os
+import time
+from urllib.parse import quote
+from station_index import normalise
+from utils import DATA_DIR, GEOCODER_URL, call_urls
+
+
+class Geocoder:
+    """Resolve place names to (lat, lon), remote geocoder last.
+
+    Names are normalised and deduplicated, then looked up in the cache of
+    previous answers (names the geocoder does not know are asked again
+    after `retry_after` seconds, failed requests on the next call),
+    then in the offline gazetteer, a csv file with name,lat,lon columns.
+    Only the names left are sent to the geocoder, as they are and then
+    with an ' ITALIA' suffix.
+    """
+
+    def __init__(self, cache_file=os.path.join(DATA_DIR, 'cache', 'geocode.json'), gazetteer_file=os.path.join(DATA_DIR, 'gazetteer.csv'),
+                 retry_after=30*24*3600):
+        self.cache_file = cache_file
+        self.retry_after = retry_after
+        self.cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                self.cache = json.load(f)
+        self.gazetteer = {}
+        if os.path.exists(gazetteer_file):
+            with open(gazetteer_file, 'r') as f:
+                for row in csv.DictReader(f):
+                    self.gazetteer[normalise(row['name'])] = (float(row['lat']), float(row['lon']))
+        logging.info("Geocoder: %s cached names, %s in the gazetteer", len(self.cache), len(self.gazetteer))
+
+    def save(self):
+        with open(self.cache_file + '.tmp', 'w') as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+    def cached(self, name, now):
+        entry = self.cache.get(name)
+        if entry is None:
+            return False, None
+        if entry.get('lat') is not None:
+            return True, (entry['lat'], entry['lon'])
+        return now - entry['at'] < self.retry_after, None
+
+    def query(self, names, suffix, client=None):
+        """Return {name: (lat, lon), or None if the geocoder answered that
+        it does not know it}; the names whose request failed are left out."""
+        url = GEOCODER_URL + '/maps/api/geocode/json?address={}'
+        pages = [{'url': url.format(quote(name + suffix)), 'name': name} for name in names]
+        logging.info("Going to make %s requests", len(pages))
+        found = {}
+        for item in call_urls(pages, client=client):
+            if item['status_code'] != 200:
+                continue
+            try:
+                content = json.loads(item['content'].decode("utf-8"))
+            except ValueError:
+                logging.warning("Cannot read the geocoder answer for %s", item['name'])
+                continue
+            if not isinstance(content, dict) or 'status' not in content:
+                continue
+            if content['status']=='OK' and len(content.get('results', []))>0:
+                location = content['results'][0]['geometry']['location']
+                found[item['name']] = (location['lat'], location['lng'])
+            elif content['status'] in ('OK', 'ZERO_RESULTS'):
+                found[item['name']] = None
+        return found
+
+    def geocode(self, names, client=None):
+        """Return {name: (lat, lon) or None} for the given names."""
+        now = time.time()
+        normalised = {name: normalise(name) for name in names}
+        positions = {}
+        remote = set()
+        for name in set(normalised.values()):
+            known, position = self.cached(name, now)
+            if known:
+                positions[name] = position
+            elif name in self.gazetteer:
+                positions[name] = self.gazetteer[name]
+            else:
+                remote.add(name)
+        logging.info("Geocoding %s names: %s known, %s to ask", len(normalised), len(positions), len(remote))
+
+        if len(remote) > 0:
+            found = self.query(sorted(remote), '', client)
+            suffixed = self.query(sorted(name for name in remote if found.get(name) is None), ' ITALIA', client)
+            for name in remote:
+                position = found.get(name) or suffixed.get(name)
+                positions[name] = position
+                if position is not None:
+                    self.cache[name] = {'lat': position[0], 'lon': position[1], 'at': now}
+                elif name in found and name in suffixed:
+                    # unknown to the geocoder: only asked again after retry_after
+                    self.cache[name] = {'at': now}
+                # else a request failed: asked again on the next run
+            self.save()
+
+        return {name: positions[normalised[name]] for name in names}
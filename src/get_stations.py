@@ -1,18 +1,27 @@
+import argparse
 import json
-from utils import call_urls
+import os
+import time
+from geocoding import Geocoder
+from http_cache import ResponseCache
+from station_index import StationIndex
+from utils import DATA_DIR, Client, VIAGGIATRENO_URL, call_urls, create_dir
 import logging
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
+# how long the responses are reused from the cache (s)
+LIST_TTL = 24*3600
+DETAIL_TTL = 30*24*3600
 
 
-def get_stations():
-    get_station_url = 'http://www.viaggiatreno.it/viaggiatrenonew/resteasy/viaggiatreno/cercaStazione/{}'
-    pages = [{'url': get_station_url.format(l)}
+def get_stations(client=None):
+    get_station_url = VIAGGIATRENO_URL + '/cercaStazione/{}'
+    pages = [{'url': get_station_url.format(l), 'ttl': LIST_TTL}
              for l in 'ABCDEFGHILMNOPQRSTUV']
-    stations = call_urls(pages)
+    stations = call_urls(pages, client=client)
     stations = [json.loads(item['content'].decode("utf-8"))
                         for item in stations
-                        if len(item['content'].decode("utf-8"))>0]
+                        if item['status_code'] == 200 and len(item['content'].decode("utf-8"))>0]
     result = {}
     for item in stations:
         for subitem in item:
@@ -20,60 +29,121 @@ def get_stations():
     return result
 
 
-def get_region(stations):
-    get_region_url = 'http://www.viaggiatreno.it/viaggiatrenonew/resteasy/viaggiatreno/regione/{}'
-    pages = [{'url': get_region_url.format(stations[s]['id'])}
-             for s in stations]
+def get_region(stations, client=None, ids=None, fetched=None):
+    """Set the region of the `ids` (all if None); the ids answered are
+    added to the set `fetched`, if given."""
+    get_region_url = VIAGGIATRENO_URL + '/regione/{}'
+    pages = [{'url': get_region_url.format(stations[s]['id']), 'ttl': DETAIL_TTL}
+             for s in (stations if ids is None else ids)]
     logging.info("Going to make %s requests", len(pages))
-    regions = call_urls(pages)
+    regions = call_urls(pages, client=client)
     for item in regions:
-        if len(item['content'].decode("utf-8"))>0:
+        if item['status_code'] == 200 and fetched is not None:
+            fetched.add(item['url'].split('/')[-1])
+        if item['status_code'] == 200 and len(item['content'].decode("utf-8"))>0:
             stations[item['url'].split('/')[-1]]['region'] = item['content'].decode("utf-8")
     return stations
 
 
-def get_coordinates(stations):
-    get_coord_url = 'http://www.viaggiatreno.it/viaggiatrenonew/resteasy/viaggiatreno/dettaglioStazione/{}/{}'
-    pages = [{'url': get_coord_url.format(stations[s]['id'], stations[s]['region'])}
-             for s in stations
+def get_coordinates(stations, client=None, ids=None, fetched=None):
+    """Merge the details of the `ids` (all if None) with a region; the
+    ids whose details were merged are added to the set `fetched`, if
+    given."""
+    get_coord_url = VIAGGIATRENO_URL + '/dettaglioStazione/{}/{}'
+    pages = [{'url': get_coord_url.format(stations[s]['id'], stations[s]['region']), 'ttl': DETAIL_TTL}
+             for s in (stations if ids is None else ids)
              if stations[s].get('region') is not None]
     logging.info("Going to make %s requests", len(pages))
-    coords = call_urls(pages)
+    coords = call_urls(pages, client=client)
     for item in coords:
-        if len(item['content'].decode("utf-8"))>0:
-            stations[item['url'].split('/')[-2]].update(json.loads(item['content'].decode("utf-8")))
+        if item['status_code'] == 200 and len(item['content'].decode("utf-8"))>0:
+            try:
+                detail = json.loads(item['content'].decode("utf-8"))
+            except ValueError:
+                logging.warning("Cannot read the details of %s", item['url'])
+                continue
+            stations[item['url'].split('/')[-2]].update(detail)
+            if fetched is not None:
+                fetched.add(item['url'].split('/')[-2])
     return stations
 
 
-def get_position(stations, more=''):
-    get_coord_url = 'http://www.datasciencetoolkit.org/maps/api/geocode/json?address={}' + more + '&?id{}'
-    pages = [{'url': get_coord_url.format(stations[s]['nomeLungo'], stations[s]['id'])}
-             for s in stations
-             if stations[s].get('lat') is None]
-    logging.info("Going to make %s requests", len(pages))
-    position = call_urls(pages)
-    for item in position:
-        content = json.loads(item['content'].decode("utf-8"))
-        if len(content)>0 and content['status']=='OK':
-            id = item['url'].split('?')[-1].replace('id','')
-            stations[id]['lon'] = content['results'][0]['geometry']['location']['lng']
-            stations[id]['lat'] = content['results'][0]['geometry']['location']['lat']
+def get_position(stations, client=None, ids=None, geocoder=None):
+    geocoder = geocoder or Geocoder()
+    missing = [s for s in (stations if ids is None else ids)
+               if stations[s].get('lat') is None and stations[s].get('nomeLungo')]
+    positions = geocoder.geocode([stations[s]['nomeLungo'] for s in missing], client)
+    for s in missing:
+        position = positions[stations[s]['nomeLungo']]
+        if position is not None:
+            stations[s]['lat'], stations[s]['lon'] = position
+    return stations
+
+
+def load_stations(fname):
+    if not os.path.exists(fname):
+        return {}
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning("Cannot read %s, fetching all the stations again", fname)
+        return {}
+
+
+def refresh_stations(stations, client, geocoder=None, max_age=30*24*3600):
+    for id, station in get_stations(client).items():
+        stations.setdefault(id, {}).update(station)
+
+    # only the new stations and those not refreshed for max_age
+    now = time.time()
+    ids = [id for id in stations if stations[id].get('updated', 0) < now - max_age]
+    logging.info("%s stations, %s new or stale", len(stations), len(ids))
+    with_region = set()
+    with_detail = set()
+    stations = get_region(stations, client, ids, with_region)
+    stations = get_coordinates(stations, client, ids, with_detail)
+    stations = get_position(stations, client, ids, geocoder)
+    # the stations whose requests failed stay stale, to be asked again on
+    # the next run; those without a region have no details to ask
+    refreshed = [id for id in ids
+                 if id in with_region and (id in with_detail or stations[id].get('region') is None)]
+    for id in refreshed:
+        stations[id]['updated'] = now
+    if len(refreshed) < len(ids):
+        logging.warning("%s stations not refreshed, retried on the next run", len(ids) - len(refreshed))
     return stations
 
 
-def main():
-    stations_raw = get_stations()
-    stations = get_region(stations_raw)
-    stations = get_coordinates(stations)
-    stations = get_position(stations, more='')
-    stations = get_position(stations, more=' ITALIA')
+def main(configs=None, client=None, geocoder=None):
+    """Refresh stations.json, .csv and .idx and return the
+    StationIndex. A long-running caller passes its own client (with its
+    cache) and geocoder, otherwise they are created for the run."""
+    configs = configs or {}
+    data_dir = configs.get('data_dir', DATA_DIR)
+    max_age = configs.get('max_age', 30*24*3600)
+
+    stations = load_stations(os.path.join(data_dir, 'stations.json'))
+    create_dir(os.path.join(data_dir, 'cache'))
+    if geocoder is None:
+        geocoder = Geocoder(os.path.join(data_dir, 'cache', 'geocode.json'),
+                            os.path.join(data_dir, 'gazetteer.csv'))
+
+    if client is None:
+        with ResponseCache(os.path.join(data_dir, 'cache', 'http.sqlite')) as cache, \
+                Client(cache=cache) as client:
+            stations = refresh_stations(stations, client, geocoder, max_age)
+    else:
+        stations = refresh_stations(stations, client, geocoder, max_age)
 
-    with open('../data/stations.json', 'w') as f:
+    with open(os.path.join(data_dir, 'stations.json'), 'w') as f:
         json.dump(stations, f, ensure_ascii=False)
+    index = StationIndex(stations)
+    index.save(os.path.join(data_dir, 'stations.idx'))
 
-    with open('../data/stations.csv', 'w') as f:
+    with open(os.path.join(data_dir, 'stations.csv'), 'w') as f:
         f.write('id,nomeLungo,nomeBreve,lon,lat,region,codRegion,tipoStazione\n')
-        for key, value in stations_ext.items():
+        for key, value in stations.items():
             f.write('{},"{}","{}",{},{},{},{},{}\n'.format(
                 value.get('id'),
                 value.get('nomeLungo'),
@@ -84,6 +154,16 @@ def main():
                 value.get('codRegion'),
                 value.get('tipoStazione')
             ))
+    return index
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Download the list of stations with their region and position')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--max-age', type=int, default=30*24*3600,
+                        help='seconds after which the details of a station are downloaded again')
+    return parser
+
 
 if __name__ == '__main__':
-    main()
+    main(vars(get_parser().parse_args()))
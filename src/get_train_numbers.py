@@ -1,64 +1,259 @@
+import argparse
 import csv
+import json
 import logging
+import os
 import time
-from random import random
-from utils import call_urls
+from contextlib import nullcontext
+from get_train_status import read_starting_stations
+from utils import DATA_DIR, Client, VIAGGIATRENO_URL, call_urls
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 
-def get_starting_station(train_list):
+def get_starting_station(train_list, client=None):
 
-    get_starting_station_url = 'http://www.viaggiatreno.it/viaggiatrenonew/resteasy/viaggiatreno/cercaNumeroTrenoTrenoAutocomplete/{}'
+    get_starting_station_url = VIAGGIATRENO_URL + '/cercaNumeroTrenoTrenoAutocomplete/{}'
     pages = [{'url': get_starting_station_url.format(n)} for n in train_list]
 
-    starting_stations = call_urls(pages)
+    starting_stations = call_urls(pages, client=client)
 
     starting_stations = ''.join([item['content'].decode("utf-8")
                                  for item in starting_stations
-                                 if len(item['content'].decode("utf-8"))>0])
+                                 if item['status_code'] == 200 and len(item['content'].decode("utf-8"))>0])
     starting_stations = starting_stations[:-1]
 
     return starting_stations
 
 
-def main(configs):
+def parse_starting_stations(content):
+    """Split an autocomplete response into [label, train number, station id] rows."""
+    rows = []
+    for item in content.split('\n'):
+        if '|' not in item:
+            continue
+        item = item.split('|')[0] + '|' \
+            + item.split('|')[1].replace('-','|')
+        rows.append(item.split('|'))
+    return rows
+
+
+def prefix_counts(pairs):
+    """Number of (station, train) pairs under every prefix of the train numbers."""
+    counts = {}
+    for station, train_number in pairs:
+        for k in range(1, len(train_number)+1):
+            counts[train_number[:k]] = counts.get(train_number[:k], 0) + 1
+    return counts
+
+
+def page_ordered(prefix, rows):
+    """Whether a full page of `prefix` is sorted so that the train numbered
+    `prefix` itself, if any, would be on it: shortest numbers first, or
+    in string order."""
+    numbers = [row[1] for row in rows]
+    return (numbers == sorted(numbers, key=lambda n: (len(n), n))
+            or numbers == sorted(numbers))
+
+
+def discover_train_numbers(known=(), max_digits=5, page_limit=10, client=None, state=None,
+                           recheck_after=0, now=None):
+    """Find the starting stations of all the trains by prefix search.
+
+    cercaNumeroTrenoTrenoAutocomplete/{prefix} lists the trains whose number
+    starts with prefix. A prefix answered with fewer than `page_limit` rows
+    is complete; otherwise its ten children are searched in the next round,
+    and children without any hit are dropped. A full page is assumed to be
+    ordered with the shortest numbers first (or as strings), so that the
+    train numbered as the prefix itself is on it; the pages that are not
+    are logged, as that train may be missed.
+
+    `state` ({prefix: {'count', 'known', 'checked', 'stable'}}, updated
+    in place) remembers the pairs found under each prefix searched. A
+    prefix whose count was unchanged when last searched, less than
+    `recheck_after` seconds ago, and with as many pairs in `known` as then
+    is not searched again, nor are its known pairs. The other pairs in
+    `known` not found are checked one by one at the end.
+    """
+
+    get_starting_station_url = VIAGGIATRENO_URL + '/cercaNumeroTrenoTrenoAutocomplete/{}'
+    now = time.time() if now is None else now
+    state = {} if state is None else state
+    known_counts = prefix_counts(known)
+    found = {}
+    requests = 0
+    searched = []
+    failed = []
+    skipped = []
+    unordered = []
+    prefixes = [str(d) for d in range(1, 10)]
+
+    while len(prefixes) > 0:
+        pages = []
+        for p in prefixes:
+            entry = state.get(p)
+            if (entry is not None and entry['stable'] and now - entry['checked'] < recheck_after
+                    and entry['known'] == known_counts.get(p, 0)):
+                skipped.append(p)
+            else:
+                pages.append({'url': get_starting_station_url.format(p), 'prefix': p})
+        logging.info("Searching %s prefixes of %s digits (%s stable skipped)",
+                     len(pages), len(prefixes[0]), len(prefixes) - len(pages))
+        requests += len(pages)
+        prefixes = []
+        for item in call_urls(pages, client=client):
+            if item['status_code'] != 200:
+                logging.warning("Prefix %s failed, its trains may be missed", item['prefix'])
+                failed.append(item['prefix'])
+                continue
+            searched.append(item['prefix'])
+            rows = parse_starting_stations(item['content'].decode("utf-8"))
+            for row in rows:
+                found[(row[2], row[1])] = row
+            if len(rows) >= page_limit and len(item['prefix']) < max_digits:
+                prefixes.extend(item['prefix'] + str(d) for d in range(10))
+                if (not any(row[1] == item['prefix'] for row in rows)
+                        and not page_ordered(item['prefix'], rows)):
+                    unordered.append(item['prefix'])
+
+    if len(unordered) > 0:
+        logging.warning("%s full pages not ordered by train number, trains numbered as their prefix "
+                        "may be missed: %s", len(unordered), ' '.join(unordered[:20]))
+
+    skipped = tuple(skipped)
+    skipped_pairs = set(pair for pair in known if pair[1].startswith(skipped))
+    missing = sorted(set(train_number for station, train_number in known
+                         if (station, train_number) not in found and (station, train_number) not in skipped_pairs))
+    if len(missing) > 0:
+        logging.info("Checking %s known trains not found by prefix", len(missing))
+        requests += len(missing)
+        for row in parse_starting_stations(get_starting_station(missing, client)):
+            found[(row[2], row[1])] = row
+
+    # a prefix is only checked if none of the searches under it failed;
+    # `known` is the number of pairs under it in the output file, which
+    # keeps the trains no longer found
+    counts = prefix_counts(set(found) | skipped_pairs)
+    known_counts = prefix_counts(set(found) | set(known))
+    for p in searched:
+        if any(f.startswith(p) for f in failed):
+            state.pop(p, None)
+            continue
+        entry = state.get(p)
+        state[p] = {'count': counts.get(p, 0), 'known': known_counts.get(p, 0), 'checked': now,
+                    'stable': entry is not None and entry['count'] == counts.get(p, 0)}
+
+    logging.info("Found %s trains with %s requests (%s known trains under stable prefixes)",
+                 len(found), requests, len(skipped_pairs))
+    return found
+
+
+def load_state(fname):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state, fname):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def main_prefix(configs, client=None):
 
-    step = configs.get('step', 100)
-    waiting_time = configs.get('waiting_time', 3)
     output_file = configs.get('output_file')
+    new_file = not os.path.exists(output_file)
+    known = set() if new_file else set(read_starting_stations(output_file))
+    logging.info("%s trains already known", len(known))
+    # the prefixes searched by the previous runs, next to the output
+    state_fname = os.path.splitext(output_file)[0] + '.prefixes.json'
+    state = {} if new_file else load_state(state_fname)
+
+    with Client() if client is None else nullcontext(client) as client:
+        found = discover_train_numbers(known, configs.get('max_digits', 5),
+                                       configs.get('page_limit', 10), client, state,
+                                       configs.get('recheck_days', 7)*86400)
 
+    # only append the new ones
+    new = [found[key] for key in sorted(found) if key not in known]
+    logging.info("Saving %s new trains", len(new))
     with open(output_file, mode='a') as f:
+        f_writer = csv.writer(f, delimiter=',',
+                              quotechar='"',
+                              quoting=csv.QUOTE_MINIMAL)
+        if new_file:
+            f_writer.writerow(['name', 'train_number', 'starting_station'])
+        f_writer.writerows(new)
+    save_state(state, state_fname)
+
+
+def main(configs, client=None):
+
+    step = configs.get('step', 100)
+    output_file = configs.get('output_file')
+    new_file = not os.path.exists(output_file)
+    known = set() if new_file else set(read_starting_stations(output_file))
+
+    with open(output_file, mode='a') as f, \
+            Client() if client is None else nullcontext(client) as client:
 
         f_writer = csv.writer(f, delimiter=',',
                               quotechar='"',
                               quoting=csv.QUOTE_MINIMAL)
+        if new_file:
+            f_writer.writerow(['name', 'train_number', 'starting_station'])
 
         for k in range(configs.get('start_from'), configs.get('up_to'), step):
-            time.sleep(random()*waiting_time)
             train_list =range(k, k+step)
             logging.info("Processing chunk from %s to %s (%s items)",
                 k, k+step, len(train_list))
 
-            starting_stations = get_starting_station(train_list)
+            starting_stations = get_starting_station(train_list, client)
 
-            if len(starting_stations)>0:
+            # only the trains not in the file yet
+            rows = []
+            for row in parse_starting_stations(starting_stations):
+                if (row[2], row[1]) not in known:
+                    known.add((row[2], row[1]))
+                    rows.append(row)
+            if len(rows)>0:
                 logging.info("Save csv")
-                for item in starting_stations.split('\n'):
-                    item = item.split('|')[0] + '|' \
-                        + item.split('|')[1].replace('-','|')
-                    f_writer.writerow(item.split('|'))
+                f_writer.writerows(rows)
             else:
                 logging.info("Nothing to save")
             logging.info("Chunk done")
 
-        f_writer.writerow('')
+
+def run(configs, client=None):
+    configs = dict(configs)
+    if not configs.get('output_file'):
+        configs['output_file'] = os.path.join(configs.get('data_dir', DATA_DIR), 'starting_stations.csv')
+    if configs.get('mode', 'prefix') == 'prefix':
+        main_prefix(configs, client)
+    else:
+        main(configs, client)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Find the starting station of every train')
+    parser.add_argument('--mode', choices=['prefix', 'range'], default='prefix',
+                        help='prefix search (default) or request every number in the range')
+    parser.add_argument('--page-limit', type=int, default=10,
+                        help='rows in an answer beyond which a prefix is split further')
+    parser.add_argument('--max-digits', type=int, default=5)
+    parser.add_argument('--recheck-days', type=float, default=7,
+                        help='days before a prefix found unchanged is searched again (default: 7, 0: always)')
+    parser.add_argument('--start-from', type=int, default=0, help='first number of the range mode')
+    parser.add_argument('--up-to', type=int, default=100000, help='end of the range mode')
+    parser.add_argument('--step', type=int, default=500, help='numbers per chunk of the range mode')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--output-file', help='default: starting_stations.csv in the data dir')
+    return parser
 
 
 if __name__ == '__main__':
+    configs = vars(get_parser().parse_args())
     logging.info("Start get_train_numbers.py")
-    configs = {'output_file': '../data/starting_stations.csv',
-               'start_from': 0,
-               'up_to': 100000,
-               'step': 500}
-    main(configs)
+    run(configs)
     logging.info("Done get_train_numbers.py")
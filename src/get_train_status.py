@@ -1,101 +1,249 @@
+import argparse
 import csv
+import io
 import logging
 import os
 import time
-from random import random
-import json
-from utils import call_urls, create_dir, logger, train
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from operator import itemgetter
+from archive import Archive
+from status_writer import StatusWriter
+import metrics
+from utils import DATA_DIR, Client, VIAGGIATRENO_URL, create_dir, iter_urls, logger, train
 from tqdm import tqdm
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
 
 
-@logger
-def get_train_status_from_API(station_id_list):
-
-    get_train_status_url = 'http://www.viaggiatreno.it/viaggiatrenonew/resteasy/viaggiatreno/andamentoTreno/{}/{}'
-    logging.info("Processing %s trains/stations", len(station_id_list))
-    pages = [{'url': get_train_status_url.format(item[0], item[1])}
-             for item in station_id_list]
+def get_train_status_from_API(station_id_list, client=None, dead_letter=None):
+    """Yield ((station, train), raw status) as soon as each train is
+    downloaded; the raw status is empty for trains unknown to the API.
 
-    train_status = call_urls(pages)
+    If given, the csv writer `dead_letter` records the pairs still failing
+    after the client's retries.
+    """
 
-    train_status = [item['content'].decode("utf-8")
-                    for item in train_status
-                    if len(item['content'].decode("utf-8"))>0]
-
-    logging.info("Returning from API the status of %s trains", len(train_status))
-    return(train_status)
+    get_train_status_url = VIAGGIATRENO_URL + '/andamentoTreno/{}/{}'
+    logging.info("Processing %s trains/stations", len(station_id_list))
+    pages = ({'url': get_train_status_url.format(item[0], item[1]),
+              'station_train': item}
+             for item in station_id_list)
+
+    returned = 0
+    failed = 0
+    for item in iter_urls(pages, client=client):
+        if item['status_code'] != 200:
+            failed += 1
+            if dead_letter is not None:
+                dead_letter.writerow(list(item['station_train'])
+                                     + [item['status_code'], item.get('error', '')])
+            continue
+        content = item['content'].decode("utf-8")
+        if len(content)>0:
+            returned += 1
+        yield item['station_train'], content
+
+    logging.info("Returned from API the status of %s trains (%s failed)", returned, failed)
+
+
+def get_train_status_batches(station_id_list, batch_size, client=None, dead_letter=None):
+    """Yield the output of get_train_status_from_API one list per
+    `batch_size` consecutive items of `station_id_list`."""
+    for k in range(0, len(station_id_list), batch_size):
+        yield list(get_train_status_from_API(station_id_list[k:(k+batch_size)],
+                                             client, dead_letter))
+
+
+def load_checkpoint(fname):
+    if not os.path.exists(fname):
+        return set()
+    with open(fname, 'r') as f:
+        return set(tuple(item) for item in csv.reader(f))
+
+
+def train_sort_key(train_number, origin_id):
+    train_number = str(train_number)
+    return (int(train_number) if train_number.isdigit() else -1, train_number, str(origin_id))
+
+
+def parse_train_status(item, trip_date=None):
+    """Return (key, train_status csv line, single_train_status csv lines)
+    for a raw status, or None if it cannot be parsed. The key is the trip
+    date followed by train_sort_key; `trip_date` is only used for the
+    statuses without orarioPartenzaZero.
+
+    The rows are formatted here, as that is most of the cost of writing
+    and it runs in the workers when there is a pool.
+    """
+    try:
+        single_train = train(item, trip_date)
+    except Exception as e:
+        logging.error("Cannot parse train status: %s", str(e))
+        return None
+
+    f_out = io.StringIO()
+    f_stat = io.StringIO()
+    try:
+        csv.writer(f_out, quoting=csv.QUOTE_MINIMAL).writerow(single_train.get_train_row())
+    except Exception as e:
+        logging.error("writer_out" + str(e)
+            + "\ntrain {}".format(single_train.train_number))
+
+    try:
+        csv.writer(f_stat, quoting=csv.QUOTE_MINIMAL).writerows(single_train.iter_segments())
+    except Exception as e:
+        logging.error("writer_stat" + str(e)
+            + "\ntrain {}".format(single_train.train_number))
+
+    return ((single_train.trip_date,) + train_sort_key(single_train.train_number, single_train.origin_id),
+            f_out.getvalue(), f_stat.getvalue())
 
 
 @logger
-def write_to_files(train_status):
-
-    today = time.strftime('%Y-%m-%d', time.localtime(time.time()))
-
-    f_out_fname = '../data/train_status/{}.csv'.format(today)
-    f_out_header = ['train_number', 'trip_date', 'train_type', 'category',
-                    'origin_id', 'origin', 'destination_id', 'destination',
-                    'num_stops', 'num_deleted_stops']
-    f_stat_fname = '../data/single_train_status/{}.csv'.format(today)
-    f_stat_header = ['train_number', 'trip_date', 'step',
-                     'from_id', 'from_planned', 'from_real',
-                     'to_id', 'to_planned', 'to_real',
-                     'inc_delay', 'seg_delay', 'fin_delay']
-
-    with open(f_out_fname, 'a') as f_out, open(f_stat_fname, 'a') as f_stat:
-        logging.info("Writing to %s and %s", f_out_fname, f_stat_fname)
-        writer_out = csv.DictWriter(f_out, fieldnames=f_out_header, quoting=csv.QUOTE_MINIMAL)
-        writer_out.writeheader()
-        writer_stat = csv.DictWriter(f_stat, fieldnames=f_stat_header, quoting=csv.QUOTE_MINIMAL)
-        writer_stat.writeheader()
-
-        for item in tqdm(train_status, disable=None, desc="Writing"):
-            single_train = train(item)
-            try:
-                writer_out.writerow(single_train.get_train_info())
-            except Exception as e:
-                logging.error("writer_out" + str(e)
-                    + "\ntrain {}".format(json.loads(item).get('numeroTreno')))
-
-            try:
-                for stop in single_train.parse_segments():
-                    writer_stat.writerow(stop)
-            except Exception as e:
-                logging.error("writer_stat" + str(e)
-                    + "\ntrain {}".format(json.loads(item).get('numeroTreno')))
-
-
-def main():
-
-    with open('../data/starting_stations.csv', 'r') as f:
+def write_to_files(batches, today=None, checkpoint=None, workers=1, archive=None, data_dir=DATA_DIR,
+                   compact=True):
+    """Parse and write batches of get_train_status_from_API output to the
+    daily files of their trip dates, each batch ordered by train number.
+
+    Trains already written are skipped, see status_writer.StatusWriter;
+    with `compact` the segments are merged into the daily files at the
+    end. With `workers` > 1 the parsing runs in a pool of processes. If
+    given, the archive.Archive `archive` stores the raw statuses before
+    they are parsed, and the csv writer `checkpoint` records the pairs of
+    each batch once the batch is written. Returns the trip dates written.
+    """
+
+    if today is None:
+        today = time.strftime('%Y-%m-%d', time.localtime(time.time()))
+
+    parse = partial(parse_train_status, trip_date=today)
+    writer = StatusWriter(data_dir)
+
+    with ProcessPoolExecutor(workers) if workers > 1 else nullcontext() as pool:
+        logging.info("Writing to %s with %s worker(s)", data_dir, workers)
+
+        for batch in tqdm(batches, disable=None, desc="Writing"):
+            payloads = [content for _, content in batch if len(content)>0]
+            if archive is not None:
+                for station_train, content in batch:
+                    if len(content)>0:
+                        archive.append(station_train, content)
+            start_time = time.perf_counter()
+            if pool is None:
+                results = map(parse, payloads)
+            else:
+                results = pool.map(parse, payloads,
+                                   chunksize=max(1, len(payloads)//(workers*4)))
+            results = sorted((result for result in results if result is not None),
+                             key=itemgetter(0))
+            parse_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            writer.write(results)
+            if checkpoint is not None:
+                checkpoint.writerows(station_train for station_train, _ in batch)
+            write_time = time.perf_counter() - start_time
+
+            # per train: parse_seconds_total / trains_parsed_total
+            metrics.observe('batch_parse_seconds', parse_time)
+            metrics.observe('batch_write_seconds', write_time)
+            metrics.inc('parse_seconds_total', parse_time)
+            metrics.inc('write_seconds_total', write_time)
+            metrics.inc('trains_parsed_total', len(results))
+            metrics.inc('parse_errors_total', len(payloads) - len(results))
+
+    if compact:
+        writer.compact_all()
+    return writer.days
+
+
+def read_starting_stations(fname=os.path.join(DATA_DIR, 'starting_stations.csv')):
+    with open(fname, 'r') as f:
         csv_reader = csv.DictReader(f)
         station_id_train = [(item['starting_station'], item['train_number'])
                             for item in csv_reader]
                             # if int(item['train_number']) < 34]
-        # TO DO: what about duplicated ids?
+    # the range mode of get_train_numbers appends the same train again on
+    # every run: keep the first of each pair, in order
+    unique = list(dict.fromkeys(station_id_train))
+    if len(unique) < len(station_id_train):
+        logging.info("Dropped %s duplicated trains/stations", len(station_id_train) - len(unique))
+    return unique
 
-    logging.info("station_id_train: %s items", len(station_id_train))
 
-    create_dir('../data/train_status')
-    create_dir('../data/single_train_status')
+def main(configs, client=None):
 
-    train_status = []
-    chunk_size = 50
-    for k in tqdm(range(0, len(station_id_train), chunk_size)):
-        try:
-            raw = get_train_status_from_API(station_id_train[k:(k+chunk_size)])
-            train_status.extend(raw)
-            time.sleep(3)
-        except:
-            logging.warning("Sleeping")
-            time.sleep(10)
+    data_dir = configs.get('data_dir', DATA_DIR)
+    station_id_train = read_starting_stations(os.path.join(data_dir, 'starting_stations.csv'))
+    # sorted, so that batches and thus the output follow the train number
+    station_id_train.sort(key=lambda item: train_sort_key(item[1], item[0]))
 
-    logging.info("train_status %s", len(train_status))
+    logging.info("station_id_train: %s items", len(station_id_train))
+
+    create_dir(os.path.join(data_dir, 'train_status'))
+    create_dir(os.path.join(data_dir, 'single_train_status'))
 
-    write_to_files(train_status)
+    # resume from the pairs already written today
+    today = time.strftime('%Y-%m-%d', time.localtime(time.time()))
+    checkpoint_fname = os.path.join(data_dir, 'train_status', '{}.done'.format(today))
+    dead_letter_fname = os.path.join(data_dir, 'train_status', '{}.failed'.format(today))
+    done = load_checkpoint(checkpoint_fname)
+    station_id_train = [item for item in station_id_train if item not in done]
+    logging.info("Skipping %s items already done, %s left", len(done), len(station_id_train))
+
+    # fetch, parse and append to the csv files one batch at a time
+    if configs.get('metrics_port'):
+        metrics.serve(configs['metrics_port'])
+    snapshots = (metrics.SnapshotWriter(configs['metrics_file'])
+                 if configs.get('metrics_file') else nullcontext())
+    with open(checkpoint_fname, 'a', buffering=1) as f_done, \
+            open(dead_letter_fname, 'w', buffering=1) as f_failed, \
+            (nullcontext() if configs.get('no_archive')
+             else Archive(today, os.path.join(data_dir, 'raw'))) as archive, \
+            snapshots, metrics.profiled('get_train_status', configs.get('profile'),
+                                        os.path.join(data_dir, 'profiles')), \
+            Client() if client is None else nullcontext(client) as client:
+        checkpoint = csv.writer(f_done)
+        dead_letter = csv.writer(f_failed)
+        batches = get_train_status_batches(station_id_train, configs.get('batch_size', 500),
+                                           client, dead_letter)
+        days = write_to_files(batches, today, checkpoint, configs.get('workers', 1), archive, data_dir)
+
+    if not configs.get('no_stats'):
+        from delay_stats import update
+        update(data_dir, days)
+
+    if configs.get('parquet'):
+        # pyarrow is only needed for the columnar copy
+        from parquet_store import convert_day
+        for day in sorted(days):
+            convert_day(day, data_dir)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Download the status of all the trains of the day')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes parsing the train status (default: 1, no pool)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='trains fetched, parsed and written together (default: 500)')
+    parser.add_argument('--no-archive', action='store_true',
+                        help='do not keep the raw statuses under raw/ in the data dir')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not update the delay statistics of the days written')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this port during the run')
+    parser.add_argument('--metrics-file',
+                        help='write a json snapshot of the metrics here every 30 s')
+    parser.add_argument('--profile', action='store_true', default=None,
+                        help='dump a cProfile of the run under profiles/ in the data dir')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also store the day in the parquet store under parquet/ in the data dir')
+    return parser
 
 
 if __name__ == '__main__':
     logging.info('Start get_train_status.py')
-    main()
+    main(vars(get_parser().parse_args()))
     logging.info('Done get_train_status.py')
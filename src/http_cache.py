@@ -0,0 +1,105 @@
+import logging
+import re
+import sqlite3
+import time
+
+
+class ResponseCache:
+    """On-disk cache of HTTP responses keyed by url.
+
+    Entries are fresh for their ttl (or the max-age the server sent), and
+    afterwards revalidated with the ETag/Last-Modified they came with. The
+    least recently used entries are evicted once the bodies stored exceed
+    `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=512*1024*1024, ttl=24*3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                           url TEXT PRIMARY KEY,
+                           content BLOB,
+                           etag TEXT,
+                           last_modified TEXT,
+                           expires_at REAL,
+                           accessed_at REAL,
+                           size INTEGER)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.puts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        logging.info("Cache: %s hits, %s revalidated, %s misses, %s MB stored",
+                     self.hits, self.revalidated, self.misses, round(self.size/2**20, 1))
+        self.db.commit()
+        self.db.close()
+
+    def get(self, url):
+        """Return the cached entry of `url` as a dict with its `content`,
+        `fresh` flag and the `headers` to revalidate it, or None."""
+        row = self.db.execute('SELECT content, etag, last_modified, expires_at FROM responses WHERE url = ?',
+                              (url,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        content, etag, last_modified, expires_at = row
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        fresh = time.time() < expires_at
+        if fresh:
+            self.hits += 1
+        return {'content': content, 'fresh': fresh, 'headers': headers}
+
+    def expires_at(self, headers, ttl):
+        match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+        if match is not None:
+            ttl = int(match.group(1))
+        return time.time() + (self.ttl if ttl is None else ttl)
+
+    def put(self, url, content, headers, ttl=None):
+        now = time.time()
+        old = self.db.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (url, content, headers.get('ETag'), headers.get('Last-Modified'),
+                         self.expires_at(headers, ttl), now, len(content)))
+        self.size += len(content) - (old[0] if old else 0)
+        self.puts += 1
+        if self.size > self.max_bytes:
+            self.evict()
+        elif self.puts % 100 == 0:
+            self.db.commit()
+
+    def refresh(self, url, headers, ttl=None):
+        """Mark `url` fresh again after a 304 Not Modified."""
+        self.revalidated += 1
+        self.db.execute('UPDATE responses SET expires_at = ? WHERE url = ?',
+                        (self.expires_at(headers, ttl), url))
+
+    def evict(self):
+        # down to 90%, so that eviction does not run at every put
+        target = self.max_bytes * 0.9
+        rows = self.db.execute('SELECT url, size FROM responses ORDER BY accessed_at').fetchall()
+        evicted = 0
+        for url, size in rows:
+            if self.size <= target:
+                break
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.size -= size
+            evicted += 1
+        self.db.commit()
+        logging.debug("Cache: evicted %s entries", evicted)
@@ -0,0 +1,180 @@
+import argparse
+import csv
+import heapq
+import logging
+import os
+import time
+from contextlib import nullcontext
+from get_train_status import get_train_status_from_API, read_starting_stations
+from utils import DATA_DIR, SEGMENT_FIELDS, Client, create_dir, train
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+def next_poll(single_train, now, min_interval=60, max_interval=1800, grace=3*3600):
+    """Return when `single_train` should be polled again (epoch seconds),
+    or None when there is nothing left to track.
+
+    The next due time is the planned time of the first stop not reached
+    yet, shifted by the delay of the last stop reached. A train that has
+    not started is left alone until its departure, one that has arrived
+    (or is `grace` seconds past its planned arrival) is dropped.
+    """
+    stops = single_train.stops
+    if len(stops) == 0 or stops[-1].get('arrivoReale') is not None:
+        return None
+
+    delay = 0
+    next_event = None
+    started = False
+    for k, stop in enumerate(stops):
+        events = []
+        if k > 0:
+            events.append(('arrivo_teorico', 'arrivoReale'))
+        if k < len(stops)-1:
+            events.append(('partenza_teorica', 'partenzaReale'))
+        for planned, real in events:
+            if stop.get(real) is not None:
+                started = True
+                if stop.get(planned) is not None:
+                    delay = stop.get(real) - stop.get(planned)
+            elif stop.get(planned) is not None and next_event is None:
+                next_event = (stop.get(planned) + delay)/1000
+        if started and next_event is not None:
+            break
+
+    last_planned = stops[-1].get('arrivo_teorico')
+    if last_planned is not None and now > last_planned/1000 + grace:
+        logging.debug("Train %s is overdue, dropping it", single_train.train_number)
+        return None
+    if next_event is None:
+        return now + max_interval
+    if not started:
+        return max(now + min_interval, next_event)
+    return min(max(now + min_interval, next_event), now + max_interval)
+
+
+class PollScheduler:
+    """Priority queue of (station, train) pairs keyed by next-due time,
+    remembering the last segments seen for each train."""
+
+    def __init__(self, station_id_train, min_interval=60, max_interval=1800, max_misses=3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_misses = max_misses
+        self.misses = {}
+        now = time.time()
+        self.queue = [(now, item) for item in set(station_id_train)]
+        heapq.heapify(self.queue)
+        self.snapshots = {}
+
+    def __len__(self):
+        return len(self.queue)
+
+    def next_due(self):
+        return self.queue[0][0]
+
+    def due(self, now):
+        items = []
+        while self.queue and self.queue[0][0] <= now:
+            items.append(heapq.heappop(self.queue)[1])
+        return items
+
+    def schedule(self, item, when):
+        if when is None:
+            self.snapshots.pop(item, None)
+        else:
+            heapq.heappush(self.queue, (when, item))
+
+    def missed(self, item, now):
+        """Reschedule `item` after a poll without answer, up to `max_misses` times."""
+        self.misses[item] = self.misses.get(item, 0) + 1
+        if self.misses[item] < self.max_misses:
+            self.schedule(item, now + self.max_interval)
+        else:
+            logging.debug("No status for train %s from %s, dropping it", item[1], item[0])
+            self.snapshots.pop(item, None)
+
+    def update(self, item, single_train, now):
+        """Reschedule `item` and return the segments changed since the last poll."""
+        # parsed before changing anything, so a payload that fails leaves
+        # the item to missed()
+        segments = single_train.parse_segments()
+        when = next_poll(single_train, now, self.min_interval, self.max_interval)
+        self.misses.pop(item, None)
+        self.schedule(item, when)
+        previous = self.snapshots.get(item, {})
+        current = {}
+        changed = []
+        for segment in segments:
+            current[segment['step']] = segment
+            if previous.get(segment['step']) != segment:
+                changed.append(segment)
+        self.snapshots[item] = current
+        return changed
+
+
+def main(configs, client=None):
+
+    data_dir = configs.get('data_dir', DATA_DIR)
+    station_id_train = read_starting_stations(os.path.join(data_dir, 'starting_stations.csv'))
+    scheduler = PollScheduler(station_id_train,
+                              configs.get('min_interval', 60),
+                              configs.get('max_interval', 1800))
+    logging.info("Tracking %s trains/stations", len(scheduler))
+
+    output_dir = os.path.join(data_dir, 'live_status')
+    create_dir(output_dir)
+    today = time.strftime('%Y-%m-%d', time.localtime(time.time()))
+    f_live_fname = os.path.join(output_dir, '{}.csv'.format(today))
+    f_live_header = ('polled_at',) + SEGMENT_FIELDS
+    new_file = not os.path.exists(f_live_fname)
+
+    with open(f_live_fname, 'a', buffering=1) as f_live, \
+            Client() if client is None else nullcontext(client) as client:
+        writer_live = csv.DictWriter(f_live, fieldnames=f_live_header, quoting=csv.QUOTE_MINIMAL)
+        if new_file:
+            writer_live.writeheader()
+
+        while len(scheduler) > 0:
+            now = time.time()
+            items = scheduler.due(now)
+            if len(items) == 0:
+                time.sleep(min(scheduler.next_due() - now, configs.get('min_interval', 60)))
+                continue
+
+            missing = set(items)
+            changed = 0
+            for item, raw in get_train_status_from_API(items, client):
+                if len(raw) == 0:
+                    continue
+                try:
+                    segments = scheduler.update(item, train(raw), now)
+                except Exception as e:
+                    logging.error("Cannot parse train status of %s: %s", item, str(e))
+                    continue
+                missing.discard(item)
+                for segment in segments:
+                    # a copy: the segment is also the snapshot compared
+                    # with the next poll
+                    writer_live.writerow(dict(segment, polled_at=round(now)))
+                    changed += 1
+
+            for item in missing:
+                scheduler.missed(item, now)
+
+            logging.info("Polled %s trains, %s changed segments, %s still tracked",
+                         len(items), changed, len(scheduler))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Follow the trains running today and log their delays')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--min-interval', type=int, default=60, help='seconds between polls of a running train')
+    parser.add_argument('--max-interval', type=int, default=1800, help='seconds between polls of an idle train')
+    return parser
+
+
+if __name__ == '__main__':
+    logging.info('Start live_status.py')
+    main(vars(get_parser().parse_args()))
+    logging.info('Done live_status.py')
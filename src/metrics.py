@@ -0,0 +1,227 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# upper bounds (s) of the latency and timing histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    """Counters, gauges and histograms of a run, keyed by name and labels.
+
+    Updated from the fetch and write paths through the module functions
+    inc, set_gauge and observe; read with snapshot or as Prometheus text
+    with to_prometheus.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            # name, labels -> [count per bucket (+inf last), count, sum]
+            self.histograms = {}
+            self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def add_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0]*(len(self.buckets)+1), 0, 0.0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def counter(self, name, **labels):
+        """Sum of the counter `name` over the series matching `labels`."""
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items()
+                       if key == name and set(labels.items()) <= set(key_labels))
+
+    def quantile(self, name, q, **labels):
+        """Upper bound of the bucket holding the `q` quantile of `name`."""
+        with self.lock:
+            counts = [0]*(len(self.buckets)+1)
+            for (key, key_labels), histogram in self.histograms.items():
+                if key == name and set(labels.items()) <= set(key_labels):
+                    counts = [a + b for a, b in zip(counts, histogram[0])]
+        total = sum(counts)
+        if total == 0:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= q*total:
+                return bound
+
+    def snapshot(self):
+        def series(items):
+            return [dict(name=name, labels=dict(labels), value=value)
+                    for (name, labels), value in sorted(items)]
+        with self.lock:
+            return {'time': time.time(),
+                    'uptime': time.time() - self.started,
+                    'counters': series(self.counters.items()),
+                    'gauges': series(self.gauges.items()),
+                    'histograms': [dict(name=name, labels=dict(labels), buckets=list(self.buckets),
+                                        counts=list(counts), count=count, sum=total)
+                                   for (name, labels), (counts, count, total)
+                                   in sorted(self.histograms.items())]}
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+        lines = []
+        with self.lock:
+            for kind, items in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(items.items()):
+                    if name not in typed:
+                        lines.append('# TYPE {} {}'.format(name, kind))
+                        typed.add(name)
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            typed = set()
+            for (name, labels), (counts, count, total) in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bound)]),
+                                                         cumulative))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+inc = registry.inc
+set_gauge = registry.set_gauge
+add_gauge = registry.add_gauge
+observe = registry.observe
+
+
+def endpoint(url):
+    """Label of a request: the API method (e.g. andamentoTreno), without
+    the ids that follow it, or 'geocode'."""
+    parts = [part for part in url.split('?')[0].split('/')[3:] if part]
+    if 'geocode' in parts:
+        return 'geocode'
+    if 'viaggiatreno' in parts:
+        parts = parts[parts.index('viaggiatreno')+1:]
+    return parts[0] if parts else ''
+
+
+def serve(port, host='0.0.0.0'):
+    """Expose the registry as Prometheus text on http://host:port/metrics,
+    from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+def write_snapshot(fname):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+
+class SnapshotWriter:
+    """Write the registry as json to `fname` every `interval` seconds and
+    once more on exit. Use it as a context manager around a run."""
+
+    def __init__(self, fname, interval=30):
+        self.fname = fname
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write_snapshot(self.fname)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        write_snapshot(self.fname)
+
+
+@contextmanager
+def profiled(name, enabled=None, directory=None):
+    """Run the block under cProfile and dump the stats to
+    {directory}/{name}-{time}.prof (profiles/ in the data dir by default), if `enabled` or, when it is None, if
+    the VIAGGIATRENO_PROFILE environment variable is set."""
+    if enabled is None:
+        enabled = bool(os.environ.get('VIAGGIATRENO_PROFILE'))
+    if not enabled:
+        yield None
+        return
+    if directory is None:
+        # utils imports this module
+        from utils import DATA_DIR
+        directory = os.path.join(DATA_DIR, 'profiles')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        fname = os.path.join(directory, '{}-{}.prof'.format(name, time.strftime('%Y%m%d-%H%M%S')))
+        profile.dump_stats(fname)
+        logging.info("Profile written to %s (python -m pstats %s)", fname, fname)
@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from aiohttp import web
+from bench_train import make_payload
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+LETTERS = 'ABCDEFGHILMNOPQRSTUV'
+
+
+def make_world(num_stations=300, num_trains=2000, seed=0):
+    """Synthetic stations and trains, the same for the same seed."""
+    rng = random.Random(seed)
+    stations = {}
+    for k in range(num_stations):
+        station_id = 'S{:05d}'.format(k)
+        name = rng.choice(LETTERS) + ''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 12)))
+        stations[station_id] = {'id': station_id,
+                                'nomeLungo': name,
+                                'nomeBreve': name[:10],
+                                'label': name[:10],
+                                'region': rng.randint(1, 22),
+                                'lat': round(rng.uniform(37, 46), 6),
+                                'lon': round(rng.uniform(7, 18), 6),
+                                # geocoding needed for these
+                                'has_coordinates': rng.random() > 0.2}
+    trains = {}
+    for number in rng.sample(range(1, 100000), num_trains):
+        # a few train numbers start from more than one station
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            stops = rng.sample(sorted(stations), rng.randint(2, 30))
+            trains.setdefault(str(number), {})[stops[0]] = stops
+    return {'stations': stations, 'trains': trains, 'numbers': sorted(trains, key=lambda n: (len(n), n))}
+
+
+def make_app(world, configs):
+    """The endpoints used by the scripts, with `latency` seconds of
+    average delay, `error_rate` 500s and `throttle_rate` 429s."""
+    stations = world['stations']
+    trains = world['trains']
+    counts = Counter()
+    payloads = {}
+
+    @web.middleware
+    async def faults(request, handler):
+        counts[request.path.split('/')[1]] += 1
+        if configs['latency'] > 0:
+            await asyncio.sleep(random.expovariate(1/configs['latency']))
+        dice = random.random()
+        if dice < configs['throttle_rate']:
+            return web.Response(status=429, headers={'Retry-After': str(configs['retry_after'])})
+        if dice < configs['throttle_rate'] + configs['error_rate']:
+            return web.Response(status=500, text='Internal Server Error')
+        recorded = os.path.join(configs['recorded'] or '', request.path.lstrip('/'))
+        if configs['recorded'] and os.path.isfile(recorded):
+            with open(recorded, 'rb') as f:
+                return web.Response(body=f.read())
+        return await handler(request)
+
+    async def cerca_stazione(request):
+        letter = request.match_info['letter']
+        return web.json_response([{key: station[key] for key in ('nomeLungo', 'nomeBreve', 'label', 'id')}
+                                  for station in stations.values()
+                                  if station['nomeLungo'].startswith(letter)])
+
+    async def regione(request):
+        station = stations.get(request.match_info['station'])
+        return web.Response(text='' if station is None else str(station['region']))
+
+    async def dettaglio_stazione(request):
+        station = stations.get(request.match_info['station'])
+        if station is None:
+            return web.Response(text='')
+        detail = {'codiceStazione': station['id'], 'codRegion': station['region'], 'tipoStazione': 1}
+        if station['has_coordinates']:
+            detail.update(lat=station['lat'], lon=station['lon'])
+        return web.json_response(detail)
+
+    async def autocomplete(request):
+        prefix = request.match_info['prefix']
+        rows = ['{} - {}|{}-{}\n'.format(number, stations[origin]['nomeLungo'], number, origin)
+                for number in world['numbers'] if number.startswith(prefix)
+                for origin in trains[number]]
+        return web.Response(text=''.join(rows[:configs['autocomplete_limit']]))
+
+    async def andamento_treno(request):
+        number = request.match_info['number']
+        origin = request.match_info['station']
+        stops = trains.get(number, {}).get(origin)
+        if stops is None:
+            return web.Response(text='')
+        if (origin, number) not in payloads:
+            start = time.mktime(time.localtime()[:3] + (5, 0, 0, 0, 0, -1))*1000
+            payloads[(origin, number)] = make_payload(int(number), start=start, station_ids=stops)
+        return web.Response(text=payloads[(origin, number)], content_type='application/json')
+
+    async def geocode(request):
+        name = request.query.get('address', '').replace(' ITALIA', '')
+        matches = [station for station in stations.values() if station['nomeLungo'] == name]
+        if len(matches) == 0 or zlib.crc32(name.encode()) % 10 < 3:
+            return web.json_response({'status': 'ZERO_RESULTS', 'results': []})
+        return web.json_response({'status': 'OK', 'results': [
+            {'geometry': {'location': {'lat': matches[0]['lat'], 'lng': matches[0]['lon']}}}]})
+
+    async def stats(request):
+        return web.json_response(counts)
+
+    app = web.Application(middlewares=[faults])
+    app.router.add_get('/cercaStazione/{letter}', cerca_stazione)
+    app.router.add_get('/regione/{station}', regione)
+    app.router.add_get('/dettaglioStazione/{station}/{region}', dettaglio_stazione)
+    app.router.add_get('/cercaNumeroTrenoTrenoAutocomplete/{prefix}', autocomplete)
+    app.router.add_get('/andamentoTreno/{station}/{number}', andamento_treno)
+    app.router.add_get('/maps/api/geocode/json', geocode)
+    app.router.add_get('/_stats', stats)
+    app['counts'] = counts
+    return app
+
+
+async def start(app, host, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def start_in_thread(configs):
+    """Start the server on a background thread and return its app."""
+    world = make_world(configs['stations'], configs['trains'], configs['seed'])
+    app = make_app(world, configs)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(start(app, configs['host'], configs['port']))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return app
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Local stand-in for the ViaggiaTreno API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--stations', type=int, default=300)
+    parser.add_argument('--trains', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.02, help='mean response delay (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 500 answers')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of 429 answers')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of the 429 answers (s)')
+    parser.add_argument('--autocomplete-limit', type=int, default=30, help='rows per autocomplete answer')
+    parser.add_argument('--recorded', help='serve the files under this directory, by url path, when present')
+    return parser
+
+
+if __name__ == '__main__':
+    configs = vars(get_parser().parse_args())
+    world = make_world(configs['stations'], configs['trains'], configs['seed'])
+    logging.info("Serving %s stations and %s trains on %s:%s, set VIAGGIATRENO_URL and GEOCODER_URL to http://%s:%s",
+                 len(world['stations']), len(world['trains']), configs['host'], configs['port'],
+                 configs['host'], configs['port'])
+    web.run_app(make_app(world, configs), host=configs['host'], port=configs['port'], access_log=None)
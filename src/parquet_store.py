@@ -0,0 +1,131 @@
+import argparse
+import datetime
+import glob
+import logging
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+from utils import DATA_DIR, logger
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+SCHEMAS = {
+    'train_status': pa.schema([
+        ('train_number', pa.int32()),
+        ('trip_date', pa.date32()),
+        ('train_type', pa.string()),
+        ('category', pa.string()),
+        ('origin_id', pa.string()),
+        ('origin', pa.string()),
+        ('destination_id', pa.string()),
+        ('destination', pa.string()),
+        ('num_stops', pa.int16()),
+        ('num_deleted_stops', pa.int16())]),
+    'single_train_status': pa.schema([
+        ('train_number', pa.int32()),
+        ('trip_date', pa.date32()),
+        ('step', pa.int16()),
+        ('from_id', pa.string()),
+        ('from_planned', pa.timestamp('ms', tz='UTC')),
+        ('from_real', pa.timestamp('ms', tz='UTC')),
+        ('to_id', pa.string()),
+        ('to_planned', pa.timestamp('ms', tz='UTC')),
+        ('to_real', pa.timestamp('ms', tz='UTC')),
+        ('inc_delay', pa.int32()),
+        ('seg_delay', pa.int32()),
+        ('fin_delay', pa.int32())])}
+
+PARTITIONING = ds.partitioning(pa.schema([('trip_date', pa.date32())]), flavor='hive')
+
+
+def read_csv(fname, name):
+    """Read one of the daily csv files into a table typed as SCHEMAS[name]."""
+    schema = SCHEMAS[name]
+    table = pv.read_csv(fname, convert_options=pv.ConvertOptions(
+        column_types={field.name: pa.string() for field in schema},
+        include_columns=schema.names,
+        strings_can_be_null=True))
+    # every append to the csv files wrote the header again
+    table = table.filter(pc.not_equal(table['train_number'], 'train_number'))
+
+    columns = []
+    for field in schema:
+        column = table[field.name]
+        if pa.types.is_timestamp(field.type):
+            # stored as epoch seconds
+            column = pc.cast(pc.round(pc.multiply(pc.cast(column, pa.float64()), 1000)), pa.int64())
+        columns.append(pc.cast(column, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_table(table, name, root=os.path.join(DATA_DIR, 'parquet')):
+    """Write `table` to the store, replacing the trip_date partitions it covers."""
+    sort_keys = [('train_number', 'ascending')]
+    if 'step' in table.column_names:
+        sort_keys.append(('step', 'ascending'))
+    ds.write_dataset(table.sort_by(sort_keys),
+                     base_dir=os.path.join(root, name),
+                     format='parquet',
+                     partitioning=PARTITIONING,
+                     basename_template='part-{i}.parquet',
+                     existing_data_behavior='delete_matching',
+                     max_rows_per_group=50000,
+                     file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+
+
+@logger
+def convert_day(day, data_dir=DATA_DIR, root=None):
+    """Convert the csv files of `day` (YYYY-MM-DD) into the parquet store."""
+    root = root or os.path.join(data_dir, 'parquet')
+    for name in SCHEMAS:
+        fname = os.path.join(data_dir, name, '{}.csv'.format(day))
+        if os.path.exists(fname):
+            table = read_csv(fname, name)
+            logging.info("Converting %s (%s rows)", fname, table.num_rows)
+            write_table(table, name, root)
+
+
+def convert_all(data_dir=DATA_DIR, root=None):
+    """Convert all the existing daily csv files."""
+    days = sorted(set(os.path.basename(fname)[:-len('.csv')]
+                      for name in SCHEMAS
+                      for fname in glob.glob(os.path.join(data_dir, name, '*.csv'))))
+    logging.info("Converting %s days", len(days))
+    for day in days:
+        convert_day(day, data_dir, root)
+
+
+def scan(name, root=os.path.join(DATA_DIR, 'parquet'), start=None, end=None, columns=None, train_numbers=None):
+    """Read `columns` of the rows between the trip dates `start` and `end`
+    (inclusive, YYYY-MM-DD) for the given trains only.
+
+    Only the partitions, columns and row groups needed are read.
+    """
+    dataset = ds.dataset(os.path.join(root, name), format='parquet', partitioning=PARTITIONING)
+    condition = None
+    for expression in [ds.field('trip_date') >= datetime.date.fromisoformat(start) if start else None,
+                       ds.field('trip_date') <= datetime.date.fromisoformat(end) if end else None,
+                       ds.field('train_number').isin(list(train_numbers)) if train_numbers else None]:
+        if expression is not None:
+            condition = expression if condition is None else condition & expression
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Convert the daily csv files into the parquet store')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--day', help='only convert this day (YYYY-MM-DD)')
+    return parser
+
+
+def main(configs):
+    if configs.get('day'):
+        convert_day(configs['day'], configs.get('data_dir', DATA_DIR))
+    else:
+        convert_all(configs.get('data_dir', DATA_DIR))
+
+
+if __name__ == '__main__':
+    main(vars(get_parser().parse_args()))
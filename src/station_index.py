@@ -0,0 +1,185 @@
+import argparse
+import difflib
+import heapq
+import json
+import math
+import os
+import pickle
+import unicodedata
+from bisect import bisect_left
+from utils import DATA_DIR
+
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def normalise(name):
+    """Upper case ascii form of a station name, for lookups."""
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(name.upper().replace('.', ' ').replace('-', ' ').split())
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*math.asin(math.sqrt(a))
+
+
+class StationIndex:
+    """Lookups over the stations saved by get_stations.
+
+    Stations are found by id, by name prefix or fuzzy name (nomeLungo and
+    nomeBreve), by region, and by position through a grid of `cell_size`
+    degrees. Build it from stations.json once and then load the snapshot
+    written by `save`.
+    """
+
+    def __init__(self, stations, cell_size=0.1):
+        self.stations = stations
+        self.cell_size = cell_size
+
+        names = {}
+        self.regions = {}
+        self.cells = {}
+        for id, station in stations.items():
+            for field in ('nomeLungo', 'nomeBreve'):
+                if station.get(field):
+                    names.setdefault(normalise(station[field]), set()).add(id)
+            region = station.get('region', station.get('codRegion'))
+            if region is not None:
+                self.regions.setdefault(str(region), []).append(id)
+            position = self.position(id)
+            if position is not None:
+                self.cells.setdefault(self.cell(*position), []).append((position[0], position[1], id))
+        self.bounds = (min(i for i, _ in self.cells), max(i for i, _ in self.cells),
+                       min(j for _, j in self.cells), max(j for _, j in self.cells)) if self.cells else None
+        self.names = sorted((name, sorted(ids)) for name, ids in names.items())
+        self.name_keys = [name for name, _ in self.names]
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __getitem__(self, id):
+        return self.stations[id]
+
+    def __contains__(self, id):
+        return id in self.stations
+
+    def get(self, id, default=None):
+        return self.stations.get(id, default)
+
+    def position(self, id):
+        """(lat, lon) of a station, or None if unknown."""
+        station = self.stations.get(id)
+        if station is None:
+            return None
+        try:
+            return float(station['lat']), float(station['lon'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat/self.cell_size)), int(math.floor(lon/self.cell_size))
+
+    def search(self, prefix, limit=10):
+        """Ids of the stations whose name starts with `prefix`."""
+        prefix = normalise(prefix)
+        found = []
+        for k in range(bisect_left(self.name_keys, prefix), len(self.names)):
+            name, ids = self.names[k]
+            if not name.startswith(prefix):
+                break
+            found.extend(id for id in ids if id not in found)
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    def fuzzy(self, name, limit=5, cutoff=0.6):
+        """Ids of the stations with the names closest to `name`."""
+        found = []
+        for match in difflib.get_close_matches(normalise(name), self.name_keys, limit, cutoff):
+            ids = self.names[bisect_left(self.name_keys, match)][1]
+            found.extend(id for id in ids if id not in found)
+        return found[:limit]
+
+    def in_region(self, region):
+        return self.regions.get(str(region), [])
+
+    def cells_around(self, lat, lon, ring):
+        """Cells at exactly `ring` cells from the one of (lat, lon)."""
+        i, j = self.cell(lat, lon)
+        for di in range(-ring, ring+1):
+            for dj in range(-ring, ring+1):
+                if max(abs(di), abs(dj)) == ring:
+                    yield self.cells.get((i+di, j+dj), ())
+
+    def ring_km(self, lat, ring):
+        # smallest distance from (lat, lon) to a cell beyond `ring`
+        return ring*self.cell_size*111.2*max(math.cos(math.radians(abs(lat) + (ring+1)*self.cell_size)), 0.01)
+
+    def nearest(self, lat, lon, k=1, max_km=None):
+        """Up to `k` (distance km, id) closest to (lat, lon), nearest first."""
+        if self.bounds is None:
+            return []
+        i, j = self.cell(lat, lon)
+        min_i, max_i, min_j, max_j = self.bounds
+        found = []
+        for ring in range(max(i-min_i, max_i-i, j-min_j, max_j-j) + 1):
+            for cell in self.cells_around(lat, lon, ring):
+                for s_lat, s_lon, id in cell:
+                    found.append((distance_km(lat, lon, s_lat, s_lon), id))
+            found = heapq.nsmallest(k, found)
+            # no station in further rings can be closer
+            if len(found) == k and found[-1][0] <= self.ring_km(lat, ring):
+                break
+            if max_km is not None and self.ring_km(lat, ring) > max_km:
+                break
+        if max_km is not None:
+            found = [item for item in found if item[0] <= max_km]
+        return found
+
+    def within(self, lat, lon, radius_km):
+        """(distance km, id) of the stations within `radius_km`, nearest first."""
+        if self.bounds is None:
+            return []
+        i, j = self.cell(lat, lon)
+        min_i, max_i, min_j, max_j = self.bounds
+        found = []
+        for ring in range(max(i-min_i, max_i-i, j-min_j, max_j-j) + 1):
+            for cell in self.cells_around(lat, lon, ring):
+                for s_lat, s_lon, id in cell:
+                    distance = distance_km(lat, lon, s_lat, s_lon)
+                    if distance <= radius_km:
+                        found.append((distance, id))
+            if self.ring_km(lat, ring) > radius_km:
+                break
+        return sorted(found)
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def from_json(fname, cell_size=0.1):
+        with open(fname, 'r') as f:
+            return StationIndex(json.load(f), cell_size)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Build the station index snapshot from stations.json')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    return parser
+
+
+def main(configs):
+    data_dir = configs.get('data_dir', DATA_DIR)
+    StationIndex.from_json(os.path.join(data_dir, 'stations.json')).save(os.path.join(data_dir, 'stations.idx'))
+
+
+if __name__ == '__main__':
+    main(vars(get_parser().parse_args()))
@@ -0,0 +1,234 @@
+import argparse
+import csv
+import fcntl
+import io
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+import metrics
+from utils import DATA_DIR, SEGMENT_FIELDS, TRAIN_FIELDS, create_dir, logger
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+TABLES = {'train_status': TRAIN_FIELDS, 'single_train_status': SEGMENT_FIELDS}
+# a train is written once per (trip_date, train_number, origin_id)
+KEY_COLUMNS = tuple(TRAIN_FIELDS.index(field) for field in ('trip_date', 'train_number', 'origin_id'))
+
+
+def header(fields):
+    f = io.StringIO()
+    csv.writer(f, quoting=csv.QUOTE_MINIMAL).writerow(fields)
+    return f.getvalue()
+
+
+def read_keys(fname):
+    """Keys of the trains in a train_status file, headers skipped."""
+    with open(fname, 'r', newline='') as f:
+        return set(tuple(row[k] for k in KEY_COLUMNS) for row in csv.reader(f)
+                   if len(row) == len(TRAIN_FIELDS) and row[0] != TRAIN_FIELDS[0])
+
+
+def write_atomic(fname, text):
+    with open(fname + '.tmp', 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fname + '.tmp', fname)
+
+
+@contextmanager
+def locked(fname):
+    with open(fname, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StatusWriter:
+    """Idempotent writer of the train_status and single_train_status files,
+    partitioned by trip date.
+
+    A train is written at most once per (trip_date, train_number,
+    origin_id), however many runs or processes write the same day. Each
+    batch is committed under the day's lock as a pair of segment files in
+    {table}/{day}.d/, written to a temporary name and renamed, the
+    train_status one last; the keys already committed (the seen-set) are
+    kept in memory and topped up from the segments of the other writers.
+    `compact` merges the segments into {table}/{day}.csv, with the header
+    only at the top.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self.seen = {}
+        self.loaded = {}
+        self.days = set()
+        self.count = 0
+        for table in TABLES:
+            create_dir(os.path.join(data_dir, table))
+
+    def base(self, table, day):
+        return os.path.join(self.data_dir, table, '{}.csv'.format(day))
+
+    def segments_dir(self, table, day):
+        return os.path.join(self.data_dir, table, '{}.d'.format(day))
+
+    def lock(self, day):
+        return locked(os.path.join(self.data_dir, 'train_status', '{}.lock'.format(day)))
+
+    def segments(self, table, day):
+        path = self.segments_dir(table, day)
+        if not os.path.exists(path):
+            return []
+        return sorted(name for name in os.listdir(path) if name.endswith('.csv'))
+
+    def refresh(self, day):
+        """Add the keys committed since the last call to the seen-set of
+        `day`. Call it holding the lock."""
+        seen = self.seen.setdefault(day, set())
+        base_state, names = self.loaded.get(day, (None, set()))
+        base = self.base('train_status', day)
+        if os.path.exists(base):
+            stat = os.stat(base)
+            state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if state != base_state:
+                seen |= read_keys(base)
+                base_state = state
+        for name in self.segments('train_status', day):
+            if name not in names:
+                seen |= read_keys(os.path.join(self.segments_dir('train_status', day), name))
+                names.add(name)
+        self.loaded[day] = (base_state, names)
+        return seen
+
+    def write(self, results):
+        """Commit the (key, train_status line, single_train_status lines)
+        of parse_train_status not written yet; key[0] is the trip date.
+        Returns the number of trains written."""
+        by_day = {}
+        for result in results:
+            by_day.setdefault(result[0][0], []).append(result)
+
+        written = 0
+        for day, day_results in sorted(by_day.items()):
+            with self.lock(day):
+                seen = self.refresh(day)
+                rows = []
+                segments = []
+                for key, row, segment_rows in day_results:
+                    key = (key[0], key[2], key[3])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    rows.append(row)
+                    segments.append(segment_rows)
+                metrics.inc('trains_skipped_total', len(day_results) - len(rows))
+                if len(rows) == 0:
+                    continue
+
+                self.count += 1
+                name = '{}-{}-{:06d}.csv'.format(time.time_ns(), os.getpid(), self.count)
+                for table, text in (('single_train_status', ''.join(segments)),
+                                    ('train_status', ''.join(rows))):
+                    create_dir(self.segments_dir(table, day))
+                    write_atomic(os.path.join(self.segments_dir(table, day), name), text)
+                self.loaded[day][1].add(name)
+                self.days.add(day)
+                written += len(rows)
+        return written
+
+    def recover(self, day):
+        """Finish a compaction of `day` interrupted after replacing some of
+        the daily files, telling them apart by their size."""
+        journal = os.path.join(self.data_dir, 'train_status', '{}.compacting'.format(day))
+        if not os.path.exists(journal):
+            return
+        with open(journal, 'r') as f:
+            state = json.load(f)
+        for table, (old_size, new_size) in state['sizes'].items():
+            base = self.base(table, day)
+            if old_size != new_size and os.path.exists(base) and os.path.getsize(base) == new_size:
+                logging.warning("Completing the compaction of %s %s", table, day)
+                for name in state['names']:
+                    fname = os.path.join(self.segments_dir(table, day), name)
+                    if os.path.exists(fname):
+                        os.remove(fname)
+        os.remove(journal)
+
+    def compact(self, day):
+        """Append the segments of `day` to its daily files. Returns whether
+        there were any."""
+        with self.lock(day):
+            self.recover(day)
+            names = self.segments('train_status', day)
+            # single_train_status segments are renamed first: one without its
+            # train_status segment is from a writer that did not commit
+            for name in set(self.segments('single_train_status', day)) - set(names):
+                logging.warning("Removing uncommitted segment %s of %s", name, day)
+                os.remove(os.path.join(self.segments_dir('single_train_status', day), name))
+            if len(names) == 0:
+                return False
+
+            sizes = {}
+            for table, fields in TABLES.items():
+                base = self.base(table, day)
+                with open(base + '.tmp', 'w') as f_out:
+                    if os.path.exists(base):
+                        with open(base, 'r') as f:
+                            shutil.copyfileobj(f, f_out)
+                    else:
+                        f_out.write(header(fields))
+                    for name in names:
+                        fname = os.path.join(self.segments_dir(table, day), name)
+                        if os.path.exists(fname):
+                            with open(fname, 'r') as f:
+                                shutil.copyfileobj(f, f_out)
+                    f_out.flush()
+                    os.fsync(f_out.fileno())
+                sizes[table] = (os.path.getsize(base) if os.path.exists(base) else 0,
+                                os.path.getsize(base + '.tmp'))
+
+            journal = os.path.join(self.data_dir, 'train_status', '{}.compacting'.format(day))
+            write_atomic(journal, json.dumps({'names': names, 'sizes': sizes}))
+            for table in ('single_train_status', 'train_status'):
+                os.replace(self.base(table, day) + '.tmp', self.base(table, day))
+                for name in names:
+                    fname = os.path.join(self.segments_dir(table, day), name)
+                    if os.path.exists(fname):
+                        os.remove(fname)
+            os.remove(journal)
+            logging.info("Compacted %s segments into %s", len(names), self.base('train_status', day))
+            return True
+
+    def compact_all(self):
+        """Compact every day with segments, the days written first.
+        Returns the days compacted."""
+        days = set(self.days)
+        path = os.path.join(self.data_dir, 'train_status')
+        days.update(name[:-2] for name in os.listdir(path) if name.endswith('.d'))
+        return [day for day in sorted(days) if self.compact(day)]
+
+
+@logger
+def main(configs):
+    writer = StatusWriter(configs.get('data_dir', DATA_DIR))
+    if configs.get('day'):
+        writer.compact(configs['day'])
+    else:
+        writer.compact_all()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Merge the segments written by the status crawls into the daily files')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--day', help='only compact this day (YYYY-MM-DD)')
+    return parser
+
+
+if __name__ == '__main__':
+    main(vars(get_parser().parse_args()))
@@ -1,16 +1,32 @@
 import asyncio
-from aiohttp import ClientSession
 import os
-from urllib.request import Request, urlopen
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
-from random import randint
+from urllib.parse import urlsplit
+from random import uniform
 import logging
 import json
 import time
+import metrics
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
 
+# overridable to run against a local stand-in, see mock_server.py
+VIAGGIATRENO_URL = os.environ.get('VIAGGIATRENO_URL',
+                                  'http://www.viaggiatreno.it/viaggiatrenonew/resteasy/viaggiatreno')
+GEOCODER_URL = os.environ.get('GEOCODER_URL', 'http://www.datasciencetoolkit.org')
+
+# default data directory of every script, data/ at the root of the repo
+# whatever the working directory
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+
+# defaults of every Client
+MAX_CONCURRENCY = 20
+RATE = 10
+
 
 def logger(fn):
     from functools import wraps
@@ -29,197 +45,371 @@ def logger(fn):
     return wrapper
 
 
-async def fetch_single(url, session):
-    async with session.get(url, allow_redirects=False, timeout=300) as response:
-        content = await response.read()
-        if response.status != 200:
+class HostLimiter:
+    """Token bucket with adaptive rate for the requests sent to one host.
+
+    The rate is halved whenever the host answers with 429/5xx or does not
+    answer, cut by a fifth when it is slower than `target_latency`, at
+    most once per second, and grows back additively on healthy responses.
+    """
+
+    def __init__(self, rate=10, burst=None, min_rate=0.5, target_latency=2.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst or max(1, int(rate))
+        self.target_latency = target_latency
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.backed_off = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def feedback(self, status, latency, retry_after=None):
+        """Adapt the rate to a response; `status` is None for a request
+        that got no answer (connection error or timeout)."""
+        now = time.monotonic()
+        failed = status is None or status == 429 or status >= 500
+        if failed and retry_after is not None:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if failed or latency > self.target_latency:
+            # slow down at most once per second, so a burst of errors or
+            # slow answers from the requests already in flight counts as a
+            # single signal
+            if now - self.backed_off < 1:
+                return
+            self.backed_off = now
+            if failed:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = 0
+                logging.info('Backing off: %s req/s (http status %s)', round(self.rate, 2), status)
+            else:
+                self.rate = max(self.min_rate, self.rate * 0.8)
+                logging.debug('Slow response (%s s): %s req/s', round(latency, 2), round(self.rate, 2))
+        else:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def fetch_single(url, session, semaphore, limiter, headers=None):
+    endpoint = metrics.endpoint(url)
+    async with semaphore:
+        await limiter.acquire()
+        metrics.add_gauge('http_in_flight', 1)
+        start_time = time.monotonic()
+        try:
+            async with session.get(url, allow_redirects=False, timeout=300, headers=headers) as response:
+                content = await response.read()
+        finally:
+            metrics.add_gauge('http_in_flight', -1)
+        latency = time.monotonic()-start_time
+        limiter.feedback(response.status, latency, retry_after_seconds(response))
+        metrics.observe('http_request_seconds', latency, endpoint=endpoint)
+        metrics.inc('http_responses_total', endpoint=endpoint, status=response.status)
+        metrics.inc('http_response_bytes_total', len(content), endpoint=endpoint)
+        if response.status not in (200, 304):
             logging.warning('Url {} - http status {}'.format(url, response.status))
         else:
             logging.debug('Url {} - http status {}'.format(url, response.status))
-        if randint(0,10)>8:
-            await asyncio.sleep(1)
-        return dict(content=content, status_code=response.status, url=url)
+        return dict(content=content, status_code=response.status, url=url,
+                    headers=response.headers)
+
+
+class Client:
+    """Long-lived HTTP client for a whole run.
+
+    Owns the event loop, one aiohttp session with its keep-alive connection
+    pool and DNS cache, and the per-host rate limiters, so they are set up
+    once instead of once per chunk. Use it as a context manager:
+
+        with Client() as client:
+            for chunk in chunks:
+                call_urls(chunk, client=client)
+
+    With a http_cache.ResponseCache as `cache`, pages with a 'ttl' key are
+    answered from it while fresh and revalidated when stale.
+    """
+
+    def __init__(self, max_concurrency=None, rate=None, dns_ttl=600, keepalive_timeout=60,
+                 retries=3, backoff=1.0, cache=None):
+        self.max_concurrency = max_concurrency or MAX_CONCURRENCY
+        self.rate = rate or RATE
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.limiters = {}
+        self.loop = None
+        self.session = None
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = self.loop.run_until_complete(self.open_session())
+        return self
+
+    def __exit__(self, *exc):
+        self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+    async def open_session(self):
+        # aiohttp takes most of the import time, only pay it when fetching
+        from aiohttp import ClientError, ClientSession, TCPConnector
+        self.errors = (ClientError, asyncio.TimeoutError)
+        connector = TCPConnector(limit=self.max_concurrency,
+                                 ttl_dns_cache=self.dns_ttl,
+                                 keepalive_timeout=self.keepalive_timeout)
+        return ClientSession(connector=connector)
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = HostLimiter(self.rate)
+        return self.limiters[host]
+
+    async def fetch(self, page):
+        """Fetch one page, retrying errors, 429 and 5xx with jittered
+        exponential backoff. Never raises: after the last attempt the
+        response (or `status_code` None and the `error`) is returned.
+        Any extra key of `page` besides 'url' is copied to the result."""
+        url = page['url']
+        cached = None
+        if self.cache is not None and 'ttl' in page:
+            cached = self.cache.get(url)
+            if cached is not None and cached['fresh']:
+                metrics.inc('http_cache_hits_total', endpoint=metrics.endpoint(url))
+                result = dict(content=cached['content'], status_code=200, url=url, cached=True)
+                result.update((k, v) for k, v in page.items() if k != 'url')
+                return result
+
+        for attempt in range(self.retries + 1):
+            try:
+                result = await fetch_single(url, self.session, self.semaphore, self.limiter(url),
+                                            cached['headers'] if cached is not None else None)
+                if result['status_code'] != 429 and result['status_code'] < 500:
+                    break
+            except self.errors as e:
+                logging.warning('Url {} - {}'.format(url, repr(e)))
+                self.limiter(url).feedback(None, None)
+                metrics.inc('http_errors_total', endpoint=metrics.endpoint(url), error=type(e).__name__)
+                result = dict(content=b'', status_code=None, url=url, error=repr(e))
+            if attempt < self.retries:
+                metrics.inc('http_retries_total', endpoint=metrics.endpoint(url))
+                await asyncio.sleep(uniform(0, self.backoff * 2**attempt))
+
+        if cached is not None and result['status_code'] == 304:
+            self.cache.refresh(url, result['headers'], page['ttl'])
+            result.update(content=cached['content'], status_code=200, cached=True)
+        elif self.cache is not None and 'ttl' in page and result['status_code'] == 200:
+            self.cache.put(url, result['content'], result['headers'], page['ttl'])
+        result.update((k, v) for k, v in page.items() if k != 'url')
+        return result
+
+    async def fetch_urls(self, urls):
+        return await asyncio.gather(*[self.fetch(url) for url in urls])
+
+    def call_urls(self, urls):
+        return self.loop.run_until_complete(self.fetch_urls(urls))
+
+    def iter_urls(self, urls):
+        urls = iter(urls)
+        pending = set()
+        try:
+            while True:
+                for url in urls:
+                    pending.add(self.loop.create_task(self.fetch(url)))
+                    if len(pending) >= self.max_concurrency:
+                        break
+                if not pending:
+                    break
+                done, pending = self.loop.run_until_complete(
+                    asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
 
 
 @logger
-async def fetch_urls(urls):
-    tasks = []
-    # Fetch all responses within one Client session,
-    # keep connection alive for all requests.
-    async with ClientSession() as session:
-        for url in urls:
-            task = asyncio.ensure_future(fetch_single(url['url'], session))
-            tasks.append(task)
-        responses = await asyncio.gather(*tasks)
-        # you now have all response bodies in this variable
-        return responses
+def call_urls(urls, client=None, **kwargs):
+    """Fetch all the urls and return the responses in the same order.
 
+    Without a `client`, a temporary one is created with `kwargs` (e.g.
+    `max_concurrency`, `rate`) and closed on return.
+    """
+    if client is None:
+        with Client(**kwargs) as client:
+            return client.call_urls(urls)
+    return client.call_urls(urls)
 
-@logger
-def call_urls(urls):
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(fetch_urls(urls))
-    results = loop.run_until_complete(future)
 
-    return results
+def iter_urls(urls, client=None, **kwargs):
+    """Like call_urls, but yield the responses as soon as they complete.
+
+    At most `max_concurrency` requests are scheduled at any time, so the
+    memory held is bounded by the window rather than by len(urls).
+    """
+    if client is None:
+        with Client(**kwargs) as client:
+            yield from client.iter_urls(urls)
+    else:
+        yield from client.iter_urls(urls)
 
 
 def create_dir(path):
     if not os.path.exists(path):
         logging.info("Creating dir %s", path)
-        os.makedirs(path)
+        # another process may create it meanwhile
+        os.makedirs(path, exist_ok=True)
 
 
-class train:
+TRAIN_FIELDS = ('train_number', 'trip_date', 'train_type', 'category',
+                'origin_id', 'origin', 'destination_id', 'destination',
+                'num_stops', 'num_deleted_stops')
 
-    def __init__(self, raw):
-
-        logging.debug("Initialising train with raw: %s...", raw[:10])
-        self.raw = json.loads(raw)
-
-        self.train_number = self.raw.get('numeroTreno', '')
-        self.train_type = self.raw.get('tipoTreno', '')
-        self.category = self.raw.get('categoria','')
-        self.trip_date = time.strftime('%Y-%m-%d', time.localtime(time.time())) # self.raw.get('orarioPartenzaZero')
-        # if self.trip_date is None:
-        #     self.trip_date = time.strftime('%Y-%m-%d', time.localtime(time.time()))
-        # else:
-        #     self.trip_date = time.strftime('%Y-%m-%d', time.localtime(self.trip_date/1000))
-        self.provision = self.raw.get('provvedimento', '')
-        self.deleted_stops = self.raw.get('fermateSoppresse', [])
-        if self.deleted_stops is None:
-            self.deleted_stops = []
-        self.origin = self.raw.get('origine', self.raw.get('origineEstera', None))
-        self.origin_id = self.raw.get('idOrigine', -1)
-        self.destination = self.raw.get('destinazione', self.raw.get('destinazioneEstera', None))
-        self.destination_id = self.raw.get('idDestinazione')
-        self.stops = self.raw.get('fermate', [])
+SEGMENT_FIELDS = ('train_number', 'trip_date', 'step',
+                  'from_id', 'from_planned', 'from_real',
+                  'to_id', 'to_planned', 'to_real',
+                  'inc_delay', 'seg_delay', 'fin_delay')
 
-        if self.train_type in ('PP', 'SI', 'SF', 'ST') or self.provision==1:
-            logging.warning('The train %s has been deleted', self.train_number)
-        if self.raw.get('haCambiNumero',False) is not False or self.raw.get('riprogrammazione', None) is not None:
-            logging.warning('The train %s has changed id', self.train_number)
 
-        logging.debug("Initialisation compleated")
+def get_single_delay(start_pl, start_real, end_pl, end_real):
+    """Return incoming, segment and final delay (s) of a segment, None
+    where the planned or real time needed is missing."""
+    try:
+        if start_pl is None or start_real is None:
+            if end_pl is None or end_real is None:
+                return None, None, None
+            return None, None, int((end_real - end_pl)/1000)
+        incoming_delay = int((start_real - start_pl)/1000)
+        if end_pl is None or end_real is None:
+            return incoming_delay, None, None
+        final_delay = int((end_real - end_pl)/1000)
+        return incoming_delay, final_delay - incoming_delay, final_delay
+    except Exception as e:
+        logging.error("%s (%s, %s), (%s, %s)", e, start_pl, start_real, end_pl, end_real)
+        return None, None, None
 
-    def __len__(self):
-        logging.debug("Returning number of stops")
-        return len(self.stops)
 
-    def __str__(self):
-        return json.dumps(self.raw)
+def get_timestamp(value):
+    return value/1000 if value is not None else None
 
 
+class train:
+    """Status of a single train, as returned by andamentoTreno.
 
-    def get_train_info(self):
-        logging.debug("Returning train info as dict")
-        return  {'train_number': self.train_number,
-                 'trip_date': self.trip_date,
-                 'train_type': self.train_type,
-                 'category': self.category,
-                 'origin_id': self.origin_id,
-                 'origin': self.origin,
-                 'destination_id': self.destination_id,
-                 'destination': self.destination,
-                 'num_stops': len(self.stops),
-                 'num_deleted_stops': len(self.deleted_stops)}
+    Only the fields used downstream are kept; segments are produced as
+    tuples ordered as SEGMENT_FIELDS by iter_segments.
+    """
 
-    def parse_segments(self):
+    __slots__ = ('train_number', 'train_type', 'category', 'trip_date',
+                 'provision', 'deleted_stops', 'origin', 'origin_id',
+                 'destination', 'destination_id', 'stops', 'changed_id')
 
-        logging.debug("Parsing segments")
+    def __init__(self, raw, trip_date=None):
 
-        def get_single_delay(start_pl, start_real, end_pl, end_real, step_n, train_n = self.train_number):
+        raw = json_loads(raw)
+        get = raw.get
 
-            logging.debug("(%s, %s), (%s, %s) for train %s - %s",
-                          start_pl, start_real, end_pl, end_real, train_n, step_n)
-            incoming_delay = None
-            segment_delay = None
-            final_delay = None
-            try:
-                if (start_pl is None or start_real is None)\
-                        and not (end_pl is None or end_real is None):
-                    logging.debug("start_* not available for train %s - %s", train_n, step_n)
-                    final_delay = int((end_real - end_pl)/1000)
+        self.train_number = get('numeroTreno', '')
+        self.train_type = get('tipoTreno', '')
+        self.category = get('categoria','')
+        # the day the train left its origin, so that trains running across
+        # midnight or fetched the day after are filed under the right day
+        departure = get('orarioPartenzaZero')
+        if departure is not None:
+            self.trip_date = time.strftime('%Y-%m-%d', time.localtime(departure/1000))
+        else:
+            self.trip_date = trip_date or time.strftime('%Y-%m-%d', time.localtime(time.time()))
+        self.provision = get('provvedimento', '')
+        self.deleted_stops = get('fermateSoppresse') or []
+        self.origin = get('origine', get('origineEstera', None))
+        self.origin_id = get('idOrigine', -1)
+        self.destination = get('destinazione', get('destinazioneEstera', None))
+        self.destination_id = get('idDestinazione')
+        self.stops = get('fermate') or []
+        self.changed_id = get('haCambiNumero',False) is not False or get('riprogrammazione', None) is not None
 
-                elif not (start_pl is None or start_real is None)\
-                        and (end_pl is None or end_real is None):
-                    logging.debug("end_* not available for train %s - %s", train_n, step_n)
-                    incoming_delay = int((start_real - start_pl)/1000)
+        if self.train_type in ('PP', 'SI', 'SF', 'ST') or self.provision==1:
+            logging.warning('The train %s has been deleted', self.train_number)
+        if self.changed_id:
+            logging.warning('The train %s has changed id', self.train_number)
 
-                elif (start_pl is None or start_real is None)\
-                        and (end_pl is None or end_real is None):
-                    logging.warning("start_* and end_* not available for train %s - %s", train_n, step_n)
+    def __len__(self):
+        return len(self.stops)
 
-                else:
-                    incoming_delay = int((start_real - start_pl)/1000)
-                    final_delay = int((end_real - end_pl)/1000)
-                    segment_delay = int(final_delay - incoming_delay)
+    def __str__(self):
+        return json.dumps({field: getattr(self, field) for field in self.__slots__})
 
-                return incoming_delay, segment_delay, final_delay
+    def get_train_row(self):
+        return (self.train_number, self.trip_date, self.train_type, self.category,
+                self.origin_id, self.origin, self.destination_id, self.destination,
+                len(self.stops), len(self.deleted_stops))
 
-            except Exception as e:
-                logging.error(str(e) + " {} - {}".format(train_n, step_n))
-                return None, None, None
+    def get_train_info(self):
+        return dict(zip(TRAIN_FIELDS, self.get_train_row()))
 
-        def get_timestamp(dict, field):
-            if dict.get(field, None) is not None:
-                return dict.get(field)/1000
-            else:
-                return None
+    def iter_segments(self):
+        """Yield two segments per stop but the last one, as tuples ordered
+        as SEGMENT_FIELDS: the stop itself (arrival to departure) and the
+        trip to the next stop (departure to arrival)."""
+
+        train_number = self.train_number
+        trip_date = self.trip_date
+        stops = self.stops
+        if len(stops) == 0:
+            logging.warning("No stops for train %s", train_number)
+            return
 
         step = 0
-        output = []
-        cum_delay = 0
+        for from_station, to_station in zip(stops, stops[1:]):
+            from_id = from_station.get('id', '')
+            arr_pl = from_station.get('arrivo_teorico')
+            arr_real = from_station.get('arrivoReale')
+            dep_pl = from_station.get('partenza_teorica')
+            dep_real = from_station.get('partenzaReale')
+            next_arr_pl = to_station.get('arrivo_teorico')
+            next_arr_real = to_station.get('arrivoReale')
 
-        if len(self.stops) == 0:
-            logger.warning("No stops for train %s", self.train_number)
-            return []
+            # from station to station itself
+            yield ((train_number, trip_date, step,
+                    from_id, get_timestamp(arr_pl), get_timestamp(arr_real),
+                    from_station.get('id'), get_timestamp(dep_pl), get_timestamp(dep_real))
+                   + get_single_delay(arr_pl, arr_real, dep_pl, dep_real))
 
-        for stop_number in range(len(self.stops)-1):
-            from_station = self.stops[stop_number]
-            to_station = self.stops[stop_number+1]
+            yield ((train_number, trip_date, step+1,
+                    from_id, get_timestamp(dep_pl), get_timestamp(dep_real),
+                    to_station.get('id'), get_timestamp(next_arr_pl), get_timestamp(next_arr_real))
+                   + get_single_delay(dep_pl, dep_real, next_arr_pl, next_arr_real))
+            step += 2
 
-            # from station to station itself
-            inc_delay, seg_delay, fin_delay = get_single_delay(from_station.get('arrivo_teorico'),
-                                                               from_station.get('arrivoReale'),
-                                                               from_station.get('partenza_teorica'),
-                                                               from_station.get('partenzaReale'),
-                                                               step)
-            output.append({'train_number': self.train_number,
-                           'trip_date': self.trip_date,
-                           'step': step,
-                           'from_id': from_station.get('id', ''),
-                           'from_planned': get_timestamp(from_station, 'arrivo_teorico'),
-                           'from_real': get_timestamp(from_station, 'arrivoReale'),
-                           'to_id': from_station.get('id'),
-                           'to_planned': get_timestamp(from_station, 'partenza_teorica'),
-                           'to_real': get_timestamp(from_station, 'partenzaReale'),
-                           'inc_delay': inc_delay,
-                           'seg_delay': seg_delay,
-                           'fin_delay': fin_delay})
-            step += 1
-
-            inc_delay, seg_delay, fin_delay = get_single_delay(from_station.get('partenza_teorica'),
-                                                               from_station.get('partenzaReale'),
-                                                               to_station.get('arrivo_teorico'),
-                                                               to_station.get('arrivoReale'),
-                                                               step)
-            output.append({'train_number': self.train_number,
-                           'trip_date': self.trip_date,
-                           'step': step,
-                           'from_id': from_station.get('id', ''),
-                           'from_planned': get_timestamp(from_station, 'partenza_teorica'),
-                           'from_real': get_timestamp(from_station, 'partenzaReale'),
-                           'to_id': to_station.get('id'),
-                           'to_planned': get_timestamp(to_station, 'arrivo_teorico'),
-                           'to_real': get_timestamp(to_station, 'arrivoReale'),
-                           'inc_delay': inc_delay,
-                           'seg_delay': seg_delay,
-                           'fin_delay': fin_delay})
-            step += 1
-
-        logging.debug("Returning list of %s dictionaries", len(output))
-        return output
+    def parse_segments(self):
+        return [dict(zip(SEGMENT_FIELDS, segment)) for segment in self.iter_segments()]
 
 
 # def test_proxy(proxy):
@@ -0,0 +1,200 @@
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from utils import DATA_DIR
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(funcName)s : %(message)s', level=logging.INFO)
+
+
+# command: (module, entry point taking the configs dict, help); the module
+# is only imported when its command runs, so that e.g. `index` does not
+# pay for aiohttp or pyarrow
+COMMANDS = {
+    'stations': ('get_stations', 'main', 'refresh the stations with their region and position'),
+    'numbers': ('get_train_numbers', 'run', 'find the starting station of every train'),
+    'status': ('get_train_status', 'main', 'download the status of all the trains of the day'),
+    'crawl': ('crawl', 'main', 'download the status of the day with workers sharing a queue'),
+    'compact': ('status_writer', 'main', 'merge the segments of the status crawls into the daily files'),
+    'live': ('live_status', 'main', 'follow the trains running today'),
+    'replay': ('archive', 'main', 'regenerate the daily csv files from the raw archive'),
+    'stats': ('delay_stats', 'main', 'update or query the delay statistics'),
+    'parquet': ('parquet_store', 'main', 'convert the daily csv files into the parquet store'),
+    'index': ('station_index', 'main', 'rebuild stations.idx from stations.json'),
+    'daemon': (None, None, 'keep running and refresh stations, trains and status on a schedule'),
+}
+
+# the scheduled jobs of the daemon, in the order they run when due together
+JOBS = ('stations', 'numbers', 'status')
+
+
+def parse_duration(value):
+    """Seconds in '3600', '90m', '12h' or '7d'."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def next_daily(at, last):
+    """When a job run every day at `at` (HH:MM) is next due: the first
+    such time after `last`."""
+    hour, minute = (int(part) for part in at.split(':'))
+    due = datetime.datetime.fromtimestamp(last).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due.timestamp() <= last:
+        due += datetime.timedelta(days=1)
+    return due.timestamp()
+
+
+def get_daemon_parser():
+    parser = argparse.ArgumentParser(prog='viaggiatreno.py daemon', description=COMMANDS['daemon'][2])
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--stations-every', type=parse_duration, default='7d',
+                        help='interval between station refreshes (default: 7d)')
+    parser.add_argument('--numbers-every', type=parse_duration, default='1d',
+                        help='interval between train discoveries (default: 1d)')
+    parser.add_argument('--status-at', default='23:30',
+                        help='local time of the daily status crawl (default: 23:30)')
+    parser.add_argument('--retry-after', type=parse_duration, default='1h',
+                        help='wait before running a failed job again (default: 1h)')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--parquet', action='store_true')
+    parser.add_argument('--metrics-port', type=int)
+    parser.add_argument('--metrics-file')
+    return parser
+
+
+class Daemon:
+    """Run the station refresh, train discovery and status crawl on a
+    schedule in one process, keeping the HTTP client with its response
+    cache, the geocoder cache and the station index between runs. The
+    index is loaded from stations.idx at start and replaced by the one
+    built by each station refresh.
+
+    The time of the last successful run of each job is kept in
+    {data_dir}/daemon.json, so a restart does not run everything again.
+    """
+
+    def __init__(self, configs):
+        self.configs = configs
+        self.data_dir = configs.get('data_dir', DATA_DIR)
+        self.state_fname = os.path.join(self.data_dir, 'daemon.json')
+        self.last = {}
+        if os.path.exists(self.state_fname):
+            with open(self.state_fname, 'r') as f:
+                self.last = json.load(f)
+        self.failed = {}
+        self.index = None
+        self.started = time.time()
+
+    def save(self):
+        with open(self.state_fname + '.tmp', 'w') as f:
+            json.dump(self.last, f)
+        os.replace(self.state_fname + '.tmp', self.state_fname)
+
+    def next_run(self, job):
+        last = self.last.get(job, 0)
+        if job == 'status':
+            # a daily job never run waits for its first time of day
+            due = next_daily(self.configs['status_at'], last or self.started)
+        else:
+            due = last + self.configs['{}_every'.format(job)]
+        if job in self.failed:
+            due = max(due, self.failed[job] + self.configs['retry_after'])
+        return due
+
+    def run_job(self, job, client, geocoder):
+        if job == 'stations':
+            import get_stations
+            self.index = get_stations.main({'data_dir': self.data_dir}, client, geocoder)
+        elif job == 'numbers':
+            import get_train_numbers
+            get_train_numbers.run({'data_dir': self.data_dir}, client)
+        elif job == 'status':
+            import get_train_status
+            get_train_status.main({'data_dir': self.data_dir,
+                                   'workers': self.configs.get('workers', 1),
+                                   'batch_size': self.configs.get('batch_size', 500),
+                                   'parquet': self.configs.get('parquet')}, client)
+
+    def run(self):
+        import metrics
+        from geocoding import Geocoder
+        from http_cache import ResponseCache
+        from station_index import StationIndex
+        from utils import Client, create_dir
+
+        create_dir(os.path.join(self.data_dir, 'cache'))
+        if os.path.exists(os.path.join(self.data_dir, 'stations.idx')):
+            self.index = StationIndex.load(os.path.join(self.data_dir, 'stations.idx'))
+        geocoder = Geocoder(os.path.join(self.data_dir, 'cache', 'geocode.json'),
+                            os.path.join(self.data_dir, 'gazetteer.csv'))
+        if self.configs.get('metrics_port'):
+            metrics.serve(self.configs['metrics_port'])
+
+        with ResponseCache(os.path.join(self.data_dir, 'cache', 'http.sqlite')) as cache, \
+                Client(cache=cache) as client:
+            while True:
+                now = time.time()
+                for job in JOBS:
+                    if self.next_run(job) > now:
+                        continue
+                    logging.info("Running %s", job)
+                    start_time = time.time()
+                    try:
+                        self.run_job(job, client, geocoder)
+                    except Exception:
+                        logging.exception("%s failed, next attempt in %s s", job, self.configs['retry_after'])
+                        self.failed[job] = time.time()
+                        metrics.inc('daemon_runs_total', job=job, result='failed')
+                        continue
+                    self.failed.pop(job, None)
+                    self.last[job] = start_time
+                    self.save()
+                    metrics.inc('daemon_runs_total', job=job, result='done')
+                    metrics.set_gauge('daemon_last_run_seconds', time.time() - start_time, job=job)
+                    if self.configs.get('metrics_file'):
+                        metrics.write_snapshot(self.configs['metrics_file'])
+
+                now = time.time()
+                due = min(self.next_run(job) for job in JOBS)
+                stations = len(self.index) if self.index is not None else 0
+                metrics.set_gauge('daemon_stations_indexed', stations)
+                logging.info("Next run at %s (%s stations indexed)",
+                             time.strftime('%Y-%m-%d %H:%M', time.localtime(due)), stations)
+                # wake up at least every 10 minutes, in case of clock changes
+                time.sleep(min(max(due - now, 1), 600))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(
+        prog='viaggiatreno.py', description='Collect the data of the ViaggiaTreno API',
+        epilog='commands:\n' + '\n'.join('  {:<10}{}'.format(command, help)
+                                         for command, (_, _, help) in COMMANDS.items())
+               + '\n\nrun `viaggiatreno.py COMMAND -h` for the options of a command',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=COMMANDS, metavar='COMMAND')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.command == 'daemon':
+        Daemon(vars(get_daemon_parser().parse_args(args.args))).run()
+        return
+
+    module_name, entry_point, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    command_parser = module.get_parser()
+    command_parser.prog = 'viaggiatreno.py ' + args.command
+    configs = vars(command_parser.parse_args(args.args))
+    logging.info('Start %s', args.command)
+    getattr(module, entry_point)(configs)
+    logging.info('Done %s', args.command)
+
+
+if __name__ == '__main__':
+    main()
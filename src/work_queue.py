@@ -0,0 +1,124 @@
+import logging
+import sqlite3
+import time
+
+
+class WorkQueue:
+    """Queue of (station, train) pairs to crawl, shared by processes
+    through a sqlite file.
+
+    Workers lease a batch of pending pairs for `lease_seconds`, and ack
+    them once written or release them to be tried again. The leases of a
+    worker that died expire and its pairs are handed to the others. A
+    pair failing `max_attempts` times is left as failed.
+    """
+
+    def __init__(self, path, max_attempts=5):
+        self.max_attempts = max_attempts
+        # the default isolation level would begin the transactions lazily
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS items (
+                           day TEXT,
+                           station TEXT,
+                           train TEXT,
+                           position INTEGER,
+                           state TEXT DEFAULT 'pending',
+                           owner TEXT,
+                           lease_expires REAL,
+                           attempts INTEGER DEFAULT 0,
+                           PRIMARY KEY (day, station, train))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS items_state ON items (day, state, position)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def put(self, day, pairs):
+        """Add the (station, train) `pairs` of `day`, in order; the pairs
+        already queued keep their state. Returns the number added."""
+        with self.transaction():
+            before = self.db.execute('SELECT COUNT(*) FROM items WHERE day = ?', (day,)).fetchone()[0]
+            self.db.executemany('INSERT OR IGNORE INTO items (day, station, train, position) VALUES (?, ?, ?, ?)',
+                                ((day, station, train, position) for position, (station, train) in enumerate(pairs)))
+            after = self.db.execute('SELECT COUNT(*) FROM items WHERE day = ?', (day,)).fetchone()[0]
+        return after - before
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def lease(self, day, owner, n, lease_seconds=300):
+        """Lease up to `n` pairs of `day`, pending or with an expired lease,
+        in queue order. The expired leases of pairs out of attempts, whose
+        workers kept dying, are marked failed instead."""
+        now = time.time()
+        with self.transaction():
+            self.db.execute('''UPDATE items SET state = 'failed', lease_expires = NULL
+                               WHERE day = ? AND state = 'leased' AND lease_expires < ? AND attempts >= ?''',
+                            (day, now, self.max_attempts))
+            rows = self.db.execute('''SELECT station, train FROM items
+                                      WHERE day = ? AND (state = 'pending'
+                                                         OR (state = 'leased' AND lease_expires < ? AND attempts < ?))
+                                      ORDER BY position LIMIT ?''', (day, now, self.max_attempts, n)).fetchall()
+            self.db.executemany('''UPDATE items SET state = 'leased', owner = ?, lease_expires = ?,
+                                   attempts = attempts + 1 WHERE day = ? AND station = ? AND train = ?''',
+                                ((owner, now + lease_seconds, day, station, train) for station, train in rows))
+        return [tuple(row) for row in rows]
+
+    def ack(self, day, owner, pairs):
+        """Mark as done the `pairs` leased by `owner`."""
+        with self.transaction():
+            self.db.executemany('''UPDATE items SET state = 'done', lease_expires = NULL
+                                   WHERE day = ? AND station = ? AND train = ? AND owner = ?''',
+                                ((day, station, train, owner) for station, train in pairs))
+
+    def release(self, day, owner, pairs):
+        """Give back the `pairs` leased by `owner` that could not be fetched,
+        to be tried again unless they ran out of attempts."""
+        with self.transaction():
+            self.db.executemany('''UPDATE items SET lease_expires = NULL,
+                                   state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END
+                                   WHERE day = ? AND station = ? AND train = ? AND owner = ? AND state = 'leased' ''',
+                                ((self.max_attempts, day, station, train, owner) for station, train in pairs))
+
+    def counts(self, day):
+        """{state: number of pairs} of `day`."""
+        return dict(self.db.execute('SELECT state, COUNT(*) FROM items WHERE day = ? GROUP BY state', (day,)))
+
+    def remaining(self, day):
+        """Pairs of `day` pending or leased."""
+        counts = self.counts(day)
+        return counts.get('pending', 0) + counts.get('leased', 0)
+
+    def failed(self, day):
+        return [tuple(row) for row in self.db.execute(
+            "SELECT station, train FROM items WHERE day = ? AND state = 'failed' ORDER BY position", (day,))]
+
+    def unfinished(self, day):
+        """Pairs of `day` still pending or leased."""
+        return [tuple(row) for row in self.db.execute(
+            "SELECT station, train FROM items WHERE day = ? AND state IN ('pending', 'leased') ORDER BY position",
+            (day,))]
+
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, so that concurrent leases never hand
+    out the same pair."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.db.execute('COMMIT')
+        else:
+            logging.warning("Rolling back the work queue transaction")
+            self.db.execute('ROLLBACK')